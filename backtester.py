@@ -2,16 +2,28 @@ import pandas as pd
 import datetime
 import numpy as np
 import data_engine as dd
+import kernels
 
 
 # General, helper variables that are used later. 
 all_dates = pd.date_range(start='1900-01-01',end='2099-12-31') # Big date range to cover all reasonable dates we may include in our backtest (This is filtered later)
+PROGRESS_EVERY = 50 # How many days to simulate between progress reports / checks for cancellation
+ENGINES = ['python', 'kernel'] # 'kernel' runs the whole simulation in kernels.simulate (compiled if numba is installed)
+REBALANCING_PARAMS = ['drift_band', 'cash_buffer', 'cost_bps'] # Path-dependent rules only some engines support
+
+
+class BacktestCancelled(Exception):
+    '''Raised inside run_backtest when the caller asks for the run to stop early.'''
 
 
 class Backtester:
 
     pretty_name = 'BaseStrategy'
     short_name = 'BaseStrat'
+    engine = 'python'
+    drift_band = 0.0
+    cash_buffer = 0.0
+    cost_bps = 0.0
 
     def __init__(
         self,
@@ -23,11 +35,29 @@ class Backtester:
         initial_capital: float = 1_000_000,
         rebal_freq: str = 'QE',
         port_name: str = 'Port',
-        params: dict = {}
+        params: dict = {},
+        engine: str = 'python'
     ) -> None:
 
-        self.data_blob = data_blob
         self.rets_df = data_blob.rets_df
+        self.setup(data_blob, tickers, weights, start_date, end_date, initial_capital, rebal_freq, port_name, params,
+                   engine)
+
+        self.portfolio = pd.Series(index=self.input_tickers,data=0.0,name=self.port_name)
+        self.portfolio['Cash'] = initial_capital
+        self.cash = 0.0
+        
+        # Master dataframe to store the historical portfolio holdings. Cash only gets a column if some is held.
+        history_columns = self.input_tickers + (['Cash'] if self.cash_buffer > 0 else [])
+        self.portfolio_history_df = pd.DataFrame(index=self.strat_dates,columns=history_columns)
+        # Value traded on each day as a fraction of the portfolio
+        self.turnover = pd.Series(index=self.strat_dates,data=0.0,name=self.port_name)
+    
+    def setup(self, data_blob, tickers: list[str], weights: list[float], start_date: str, end_date: str,
+              initial_capital: float, rebal_freq: str, port_name: str, params: dict, engine: str = 'python') -> None:
+        '''Store the inputs, work out the backtest and rebalance dates, and validate. Shared by every engine.'''
+
+        self.data_blob = data_blob
         self.input_tickers = tickers
         self.input_weights = weights
         self.port_name = port_name
@@ -39,19 +69,19 @@ class Backtester:
         # Make sure the end date is not included in the rebalance dates
         self.rebalance_dates = self.rebalance_dates[self.rebalance_dates != end_date]
 
-        self.validate_data()
+        self.initial_capital = initial_capital
+        self.engine = engine
 
+        # Just a catch all for any additional parameters that may be passed in for a substrategy. The base strategy
+        # understands drift_band (only rebalance if a weight has drifted this far from its target), cash_buffer
+        # (fraction of the portfolio held in cash after each rebalance) and cost_bps (charged on the value traded).
+        self.params = params
+        self.drift_band = params.get('drift_band', 0.0)
+        self.cash_buffer = params.get('cash_buffer', 0.0)
+        self.cost_bps = params.get('cost_bps', 0.0)
 
-        self.portfolio = pd.Series(index=self.input_tickers,data=0.0,name=self.port_name)
-        self.portfolio['Cash'] = initial_capital
-        
-        # Master dataframe to store the historical portfolio holdings
-        self.portfolio_history_df = pd.DataFrame(index=self.strat_dates,columns=self.input_tickers)
-        # self.portfolio_history_df.index.name
+        self.validate_data()
 
-        # Just a catch all for any additional parameters that may be passed in for a substrategy
-        self.params = params
-    
     def validate_data(self) -> None:
 
         # Check that the input tickers are in the data blob
@@ -63,6 +93,14 @@ class Backtester:
         if np.abs(np.sum(self.input_weights) - 1) > 1e-8:
             raise ValueError('Input weights do not sum to 1. Please check the input weights.')
 
+        if self.engine not in ENGINES:
+            raise ValueError(f'Unknown engine {self.engine}. Please choose one of {ENGINES}.')
+
+    def require_plain_rebalancing(self) -> None:
+        '''For engines that only do plain calendar rebalancing: refuse params they would otherwise silently ignore.'''
+        unsupported = [p for p in REBALANCING_PARAMS if self.params.get(p, 0)]
+        if unsupported:
+            raise ValueError(f'{self.pretty_name} does not support {unsupported}. Use Backtester instead.')
         
 
     def __repr__(self) -> str:
@@ -70,7 +108,14 @@ class Backtester:
 
     @property
     def port_value(self) -> float:
-        return self.portfolio.sum()
+        return self.portfolio.sum() + self.cash
+
+    def record_portfolio(self) -> None:
+        '''Store the current holdings (and cash, if any is held) in the history for the current date.'''
+        if self.cash_buffer > 0:
+            self.portfolio_history_df.loc[self.current_date] = pd.concat([self.portfolio, pd.Series({'Cash': self.cash})])
+        else:
+            self.portfolio_history_df.loc[self.current_date] = self.portfolio
 
     def rebalance_to_target_weights(self,target_weights:pd.Series) -> None:
         '''Rebalance the portfolio to the target weights provided. This will implictily involve selling off any
@@ -78,13 +123,30 @@ class Backtester:
     
         '''
     
-        # Multiply the target weights by the current portfolio value to get the target value for each security
-        target_values = target_weights * self.port_value
+        # Multiply the target weights by the current portfolio value (less any cash buffer) to get the target value
+        # for each security
+        value = self.port_value
+        target_values = target_weights * (value * (1 - self.cash_buffer))
+
+        # Trading costs come out of the portfolio before it is split between the securities and cash
+        traded = (target_values - self.portfolio.reindex(target_weights.index).fillna(0)).abs().sum()
+        self.turnover[self.current_date] = traded / value
+        value -= traded * self.cost_bps / 10_000
+        invested = value * (1 - self.cash_buffer)
 
         # Update the new portfolio with the target values 
         # (This is implicitly carrying out trades...)
-        self.portfolio = target_values
-        self.portfolio_history_df.loc[self.current_date] = self.portfolio
+        self.portfolio = target_weights * invested
+        self.cash = value - invested
+        self.record_portfolio()
+
+    def needs_rebalance(self, target_weights: pd.Series) -> bool:
+        '''With a drift band set, only rebalance when some weight has drifted outside it.'''
+
+        if self.drift_band <= 0:
+            return True
+        drift = (self.portfolio / self.port_value - target_weights * (1 - self.cash_buffer)).abs().max()
+        return drift > self.drift_band
     
 
     def increment_portfolio_by_returns(self) -> None:
@@ -96,7 +158,7 @@ class Backtester:
             
         # Regardless of if portfolio was incremented up or not, store the current portfolio value in the history for
         #  today's date. So we always have an estimated value for the portfolio at the end of each day.
-        self.portfolio_history_df.loc[self.current_date] = self.portfolio
+        self.record_portfolio()
 
     
     def get_target_weights(self) -> pd.Series:
@@ -107,14 +169,27 @@ class Backtester:
 
         return target_weights
 
-    def run_backtest(self,verbose=False) -> None:
+    def run_backtest(self,verbose=False,progress=None,cancel_event=None) -> None:
+        '''Run the backtest. progress, if given, is called as progress(days_done, total_days) every so often, and
+        setting cancel_event (a threading.Event) stops the run with a BacktestCancelled error.'''
+
+        if self.engine == 'kernel':
+            self.run_kernel_backtest(progress=progress, cancel_event=cancel_event)
+            return
 
         # Allocate the initial capital to the target weights
         target_weights = self.get_target_weights()
         self.rebalance_to_target_weights(target_weights)
+        n_days = len(self.strat_dates)
 
         # Iterate through all the dates in the chosen time period
-        for date in self.strat_dates[1:]:
+        for days_done, date in enumerate(self.strat_dates[1:], start=2):
+
+            if days_done % PROGRESS_EVERY == 0:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise BacktestCancelled(f'Backtest cancelled at {date.date()}')
+                if progress is not None:
+                    progress(days_done, n_days)
             
             # Update the current date
             self.current_date = date
@@ -127,10 +202,47 @@ class Backtester:
                 if verbose:
                     print(f'Current Time {datetime.datetime.now()} Rebalancing: {date}')
                 target_weights = self.get_target_weights()
-                self.rebalance_to_target_weights(target_weights)
+                if self.needs_rebalance(target_weights):
+                    self.rebalance_to_target_weights(target_weights)
 
         # Calculate some useful data based on the portfolio history
         self.calculate_data()
+        if progress is not None:
+            progress(n_days, n_days)
+
+
+    def run_kernel_backtest(self,progress=None,cancel_event=None) -> None:
+        '''Run the same simulation as run_backtest in one call to kernels.simulate, instead of stepping through the
+        days in pandas.'''
+
+        if cancel_event is not None and cancel_event.is_set():
+            raise BacktestCancelled(f'Backtest cancelled at {self.strat_dates[0].date()}')
+
+        # Growth factor for every calendar day. Days without a return (weekends, holidays) are flat. Reading straight
+        # from the returns array means only the rows and columns we need get copied (and nothing at all is reindexed
+        # when the data comes from a universes.Universe).
+        ret_rows = self.rets_df.index.get_indexer(self.strat_dates)
+        ret_cols = self.rets_df.columns.get_indexer(self.input_tickers)
+        growth = np.ones((len(self.strat_dates), len(self.input_tickers)))
+        growth[ret_rows >= 0] += self.rets_df.to_numpy(dtype=np.float64)[np.ix_(ret_rows[ret_rows >= 0], ret_cols)]
+        is_rebal_day = self.strat_dates.isin(self.rebalance_dates)
+
+        holdings, cash, turnover = kernels.simulate(
+            growth, self.get_target_weights().to_numpy(), is_rebal_day, self.initial_capital,
+            drift_band=self.drift_band, cash_buffer=self.cash_buffer, cost_bps=self.cost_bps,
+        )
+
+        self.portfolio_history_df = pd.DataFrame(holdings, index=self.strat_dates, columns=self.input_tickers)
+        if self.cash_buffer > 0:
+            self.portfolio_history_df['Cash'] = cash
+        self.turnover = pd.Series(turnover, index=self.strat_dates, name=self.port_name)
+        self.portfolio = pd.Series(holdings[-1], index=self.input_tickers, name=self.port_name)
+        self.cash = cash[-1]
+        self.current_date = self.strat_dates[-1]
+
+        self.calculate_data()
+        if progress is not None:
+            progress(len(self.strat_dates), len(self.strat_dates))
 
 
     def calculate_data(self) -> None:
@@ -138,6 +250,11 @@ class Backtester:
         
         self.total_port_values = self.portfolio_history_df.sum(axis=1).astype(float).rename(self.port_name)
         self.weights_df = (self.portfolio_history_df.div(self.total_port_values,axis=0)).astype(float)
+        self.calculate_port_returns()
+
+    def calculate_port_returns(self) -> None:
+        '''Wealth index and portfolio returns, from total_port_values.'''
+
         self.wealth_index = self.total_port_values / self.total_port_values.iloc[0]
 
         self.cumulative_port_returns = self.wealth_index - 1
@@ -151,8 +268,6 @@ class Backtester:
         basically_zero_mask = np.abs(self.portfolio_returns_all - 0) < 1e-8
         self.port_returns = self.portfolio_returns_all[~basically_zero_mask].copy()
 
-        ''
-
 
 
 if __name__ == '__main__':
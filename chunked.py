@@ -0,0 +1,232 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+import backtester as bt
+
+
+STORE_VALUES_FILE = 'values.npy'
+STORE_DATES_FILE = 'dates.npy'
+STORE_TICKERS_FILE = 'tickers.json'
+DEFAULT_CHUNK_DAYS = 2520  # Roughly 10 years of calendar days per chunk
+
+
+class ReturnsStore:
+    '''Returns matrix stored on disk as a memory-mapped, row (date) ordered .npy file. Only the rows and columns
+    that are actually read get paged into memory, so the matrix can be far bigger than RAM.'''
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.values = np.load(os.path.join(folder, STORE_VALUES_FILE), mmap_mode='r')
+        self.dates = np.load(os.path.join(folder, STORE_DATES_FILE))
+        with open(os.path.join(folder, STORE_TICKERS_FILE)) as f:
+            self._tickers = json.load(f)
+        self._ticker_pos = {ticker: i for i, ticker in enumerate(self._tickers)}
+
+    @property
+    def tickers(self) -> list[str]:
+        return self._tickers
+
+    @staticmethod
+    def from_frame(rets_df: pd.DataFrame, folder: str, chunk_rows: int = 100_000) -> "ReturnsStore":
+        '''Write an in-memory returns DataFrame to a store.'''
+
+        return ReturnsStore.from_chunks(
+            (rets_df.iloc[i:i + chunk_rows] for i in range(0, len(rets_df), chunk_rows)),
+            n_rows=len(rets_df),
+            tickers=rets_df.columns.tolist(),
+            folder=folder,
+        )
+
+    @staticmethod
+    def from_csv(csv_path: str, folder: str, chunk_rows: int = 100_000) -> "ReturnsStore":
+        '''Stream a returns csv (like the one written by DataEngine.save_data) into a store without ever loading
+        the whole thing.'''
+
+        with open(csv_path) as f:
+            tickers = f.readline().strip().split(',')[1:]
+            n_rows = sum(1 for _ in f)
+        chunks = pd.read_csv(csv_path, index_col=0, parse_dates=True, chunksize=chunk_rows)
+        return ReturnsStore.from_chunks(chunks, n_rows=n_rows, tickers=tickers, folder=folder)
+
+    @staticmethod
+    def from_chunks(chunks, n_rows: int, tickers: list[str], folder: str) -> "ReturnsStore":
+        '''Write date ordered DataFrame chunks (all with the same columns) to a store.'''
+
+        os.makedirs(folder, exist_ok=True)
+        values = open_memmap(os.path.join(folder, STORE_VALUES_FILE), mode='w+', dtype=np.float64,
+                             shape=(n_rows, len(tickers)))
+        dates = np.empty(n_rows, dtype='datetime64[ns]')
+
+        row = 0
+        for chunk in chunks:
+            chunk_values = chunk[tickers].to_numpy(dtype=np.float64)
+            values[row:row + len(chunk_values)] = chunk_values
+            dates[row:row + len(chunk_values)] = pd.to_datetime(chunk.index).to_numpy(dtype='datetime64[ns]')
+            row += len(chunk_values)
+
+        if row != n_rows:
+            raise ValueError(f'Expected {n_rows} rows but only received {row}.')
+        if np.any(np.diff(dates) <= np.timedelta64(0)):
+            raise ValueError('Returns must be in strictly increasing date order.')
+
+        values.flush()
+        del values
+        np.save(os.path.join(folder, STORE_DATES_FILE), dates)
+        with open(os.path.join(folder, STORE_TICKERS_FILE), 'w') as f:
+            json.dump(tickers, f)
+
+        return ReturnsStore(folder)
+
+    def read(self, start, end, tickers: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        '''Read the dates and returns (for just the given tickers) within [start, end].'''
+
+        lo = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+        hi = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+        cols = [self._ticker_pos[ticker] for ticker in tickers]
+        return self.dates[lo:hi], self.values[lo:hi][:, cols]
+
+
+class ChunkedBacktester(bt.Backtester):
+    '''Out-of-core version of the Backtester. Returns are streamed from a ReturnsStore in date ordered chunks,
+    the holdings are carried across chunk boundaries and the history is written straight to a memory-mapped file.
+    Peak memory is set by chunk_days, not by the length of the backtest.
+
+    Gives exactly the same numbers as Backtester, because every holding is still compounded one day at a time in
+    the same order. Only plain calendar rebalancing is supported, so drift_band, cash_buffer and cost_bps are
+    rejected.
+
+    Without an output_folder the history goes in a temp folder that belongs to the backtest. Call close (or use
+    the backtest as a context manager) once done with the results to delete it.
+    '''
+
+    pretty_name = 'ChunkedStrategy'
+    short_name = 'ChunkedStrat'
+
+    def __init__(
+        self,
+        data_blob: ReturnsStore,
+        tickers: list[str],
+        weights: list[float],
+        start_date: str,
+        end_date: str,
+        initial_capital: float = 1_000_000,
+        rebal_freq: str = 'QE',
+        port_name: str = 'Port',
+        params: dict = {},
+        chunk_days: int = DEFAULT_CHUNK_DAYS,
+        output_folder: str = None,
+    ) -> None:
+
+        # No super().__init__: that would allocate the full size history this engine exists to avoid
+        self.setup(data_blob, tickers, weights, start_date, end_date, initial_capital, rebal_freq, port_name, params)
+        self.require_plain_rebalancing()
+        self.chunk_days = chunk_days
+        self._owns_output_folder = output_folder is None
+        self.output_folder = output_folder or tempfile.mkdtemp(prefix='backtest_')
+
+    def __enter__(self) -> "ChunkedBacktester":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        '''Let go of the on-disk history, deleting it if it's in the temp folder made for this backtest.'''
+        self.portfolio_history_df = None
+        if self._owns_output_folder:
+            shutil.rmtree(self.output_folder, ignore_errors=True)
+
+    def run_backtest(self, verbose=False, progress=None, cancel_event=None) -> None:
+
+        os.makedirs(self.output_folder, exist_ok=True)
+        n_days = len(self.strat_dates)
+        target_weights = np.asarray(self.input_weights, dtype=np.float64)
+        history = open_memmap(os.path.join(self.output_folder, 'history.npy'), mode='w+', dtype=np.float64,
+                              shape=(n_days, len(self.input_tickers)))
+        totals = np.empty(n_days, dtype=np.float64)
+        is_rebal_day = self.strat_dates.isin(self.rebalance_dates)
+        cal_dates = self.strat_dates.to_numpy(dtype='datetime64[ns]')
+
+        # Allocate the initial capital to the target weights on the first day
+        holdings = target_weights * self.initial_capital
+        history[0] = holdings
+        totals[0] = np.nansum(holdings)
+
+        for chunk_start in range(1, n_days, self.chunk_days):
+            if cancel_event is not None and cancel_event.is_set():
+                raise bt.BacktestCancelled(f'Backtest cancelled at {pd.Timestamp(cal_dates[chunk_start]).date()}')
+            chunk_end = min(chunk_start + self.chunk_days, n_days)
+            chunk_dates = cal_dates[chunk_start:chunk_end]
+
+            # Growth factor for every calendar day in the chunk. Days without a return (weekends, holidays) are flat.
+            growth = np.ones((len(chunk_dates), len(self.input_tickers)))
+            ret_dates, rets = self.data_blob.read(chunk_dates[0], chunk_dates[-1], self.input_tickers)
+            growth[np.searchsorted(chunk_dates, ret_dates)] += rets
+
+            # Compound each stretch between rebalances in one go. Seeding the cumprod with the starting holdings
+            # keeps the multiplication order (and so the result) identical to the day by day engine.
+            chunk_history = np.empty_like(growth)
+            rebal_rows = np.flatnonzero(is_rebal_day[chunk_start:chunk_end])
+            seg_start = 0
+            for seg_end in list(rebal_rows + 1) + [len(growth)]:
+                if seg_end <= seg_start:
+                    continue
+                segment = np.cumprod(np.vstack([holdings, growth[seg_start:seg_end]]), axis=0)[1:]
+                chunk_history[seg_start:seg_end] = segment
+                holdings = segment[-1]
+                if seg_end - 1 in rebal_rows:
+                    if verbose:
+                        print(f'Rebalancing: {pd.Timestamp(chunk_dates[seg_end - 1]).date()}')
+                    holdings = target_weights * np.nansum(holdings)
+                    chunk_history[seg_end - 1] = holdings
+                seg_start = seg_end
+
+            history[chunk_start:chunk_end] = chunk_history
+            totals[chunk_start:chunk_end] = np.nansum(chunk_history, axis=1)
+            self.current_date = pd.Timestamp(chunk_dates[-1])
+            if progress is not None:
+                progress(chunk_end, n_days)
+
+        history.flush()
+        del history
+        self.portfolio = pd.Series(holdings, index=self.input_tickers, name=self.port_name)
+        self.calculate_data(totals)
+
+    def calculate_data(self, totals: np.ndarray) -> None:
+        '''Same outputs as Backtester.calculate_data, but the full size frames are backed by the on-disk history.'''
+
+        self.portfolio_history_df = pd.DataFrame(
+            np.load(os.path.join(self.output_folder, 'history.npy'), mmap_mode='r'),
+            index=self.strat_dates, columns=self.input_tickers, copy=False,
+        )
+        self.total_port_values = pd.Series(totals, index=self.strat_dates, name=self.port_name)
+        self.calculate_port_returns()
+
+    @property
+    def weights_df(self) -> pd.DataFrame:
+        # Built on request rather than stored, since it's the same size as the full history
+        return self.portfolio_history_df.div(self.total_port_values, axis=0)
+
+
+if __name__ == '__main__':
+    import data_engine as dd
+
+    data = dd.DataEngine.load_saved_data('data/')
+    store = ReturnsStore.from_csv('data/rets_df.csv', tempfile.mkdtemp(prefix='returns_store_'), chunk_rows=1000)
+
+    args = dict(tickers=['AAPL', 'MSFT', 'SPY'], weights=[0.3, 0.3, 0.4], start_date='2005-01-01',
+                end_date='2020-01-01', rebal_freq='ME')
+    in_memory = bt.Backtester(data_blob=data, **args)
+    in_memory.run_backtest()
+    with ChunkedBacktester(data_blob=store, chunk_days=365, **args) as chunked:
+        chunked.run_backtest()
+        diff = (in_memory.portfolio_history_df.astype(float) - chunked.portfolio_history_df).abs().max().max()
+        # Should be exactly the same as the in-memory engine
+        assert diff == 0, diff
+        print(f'Max holding diff vs in-memory engine: {diff}')
+    assert not os.path.exists(chunked.output_folder)
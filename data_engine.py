@@ -1,15 +1,17 @@
 import os
+import hashlib
 import time
 import pandas as pd
 import yfinance as yf
 import datetime as dt
 import constants as C
+from data_quality import DataQualityIndex
+from snapshots import SnapshotStore, tickers_version
 import streamlit as st
 
 # DATA_FOLDER = 'data/'
 DATA_FOLDER = 'temp_data/'
-CACHE_EXPIRATION = 28800  # 8ish hours
-MAX_FILES_SAVED = 100
+CACHE_EXPIRATION = 28800  # 8ish hours. How often we re-check the source, not whether the data changed.
 
 class DataEngine:
     def __init__(self) -> None:
@@ -17,47 +19,49 @@ class DataEngine:
         self.rets_df: pd.DataFrame = None
         self.price_df: pd.DataFrame = None
         self.raw_data_df: pd.DataFrame = None
+        self.quality: DataQualityIndex = None
+        # Which snapshot the data came from, and the content hash of each ticker's data
+        self.snapshot_version: str = None
+        self.ticker_hashes: dict[str, str] = {}
 
-    def is_cache_expired(self, ticker: str) -> bool:
-        file_path = f'{DATA_FOLDER}{ticker}.csv'
-        if not os.path.exists(file_path):
+    @property
+    def snapshots(self) -> SnapshotStore:
+        return SnapshotStore(DATA_FOLDER)
+
+    def is_cache_expired(self, ticker: str, freshness: dict[str, float] = None) -> bool:
+        """True if the ticker hasn't been fetched from the source within CACHE_EXPIRATION"""
+        freshness = self.snapshots.freshness() if freshness is None else freshness
+        if ticker not in freshness:
             return True
-        return (time.time() - os.path.getmtime(file_path)) > CACHE_EXPIRATION 
+        return (time.time() - freshness[ticker]) > CACHE_EXPIRATION
 
-    def load_local_data(self, tickers: list[str]) -> pd.DataFrame:
-        """Load data from local storage if available and not expired"""
+    def load_local_data(self, tickers: list[str], version: str = None) -> pd.DataFrame:
+        """Load data from the local snapshots if available and not expired. Passing a version loads exactly that
+        snapshot, regardless of how old it is."""
 
-        dfs = []
-        for ticker in tickers:
-            if self.is_cache_expired(ticker):
+        snapshots = self.snapshots
+        if version is None:
+            freshness = snapshots.freshness()
+            if any(self.is_cache_expired(ticker, freshness) for ticker in tickers):
                 # If any of the tickers are expired, return None (Meaning we will re-download everything)
                 return None
-            file_path = f'{DATA_FOLDER}{ticker}.csv'
-            if os.path.exists(file_path):
-                df = pd.read_csv(file_path, index_col=0, parse_dates=True)
-                df.columns = pd.MultiIndex.from_product([[ticker], df.columns])
-                dfs.append(df)
-        return pd.concat(dfs, axis=1) if dfs else None
 
-    def check_storage_limit(self):
-        """Checks if adding new files will exceed MAX_FILES_SAVED and clears folder if necessary"""
-        if not os.path.exists(DATA_FOLDER):
-            os.makedirs(DATA_FOLDER)
-            return
-        
-        existing_files = [f for f in os.listdir(DATA_FOLDER) if f.endswith('.csv')]
-        if len(existing_files) >= MAX_FILES_SAVED:
-            print("Storage limit exceeded, clearing folder...")
-            for file in existing_files:
-                os.remove(os.path.join(DATA_FOLDER, file))
+        ticker_dfs, self.ticker_hashes = snapshots.load(tickers, version)
+        self.snapshot_version = version or snapshots.latest_version
+
+        dfs = []
+        for ticker, df in ticker_dfs.items():
+            df.columns = pd.MultiIndex.from_product([[ticker], df.columns])
+            dfs.append(df)
+        return pd.concat(dfs, axis=1) if dfs else None
 
     def save_data_locally(self, df: pd.DataFrame, tickers: list[str]) -> None:
-        """Save downloaded data locally after checking storage limit"""
-        self.check_storage_limit()
-        os.makedirs(DATA_FOLDER, exist_ok=True)
-        for ticker in tickers:
-            mini_df = df[[ticker]].droplevel(0, axis=1).dropna()
-            mini_df.to_csv(f'{DATA_FOLDER}{ticker}.csv')
+        """Save downloaded data as a new snapshot version. Tickers whose data didn't change are left as is."""
+        snapshots = self.snapshots
+        ticker_dfs = {ticker: df[[ticker]].droplevel(0, axis=1).dropna() for ticker in tickers}
+        self.snapshot_version = snapshots.commit(ticker_dfs)
+        manifest = snapshots.manifest(self.snapshot_version)
+        self.ticker_hashes = {ticker: manifest['tickers'][ticker] for ticker in tickers}
 
     def download_new_data(self, tickers: list[str]) -> pd.DataFrame:
         tickers = list(dict.fromkeys(tickers))  # Remove duplicates
@@ -69,6 +73,9 @@ class DataEngine:
         #     # print("Fetching new data from Yahoo Finance")
         self.raw_data_df = yf.download(tickers, group_by='ticker', auto_adjust=False, actions=False)
         self.save_data_locally(self.raw_data_df, tickers)
+        # Carry on with the snapshot we just saved, so a fresh download gives exactly the same data (and the same
+        # saved quality index) as loading this version later
+        self.raw_data_df = self.load_local_data(tickers, self.snapshot_version)
 
         self.clean_data()
         return self.rets_df
@@ -82,12 +89,26 @@ class DataEngine:
 
         adjusted_prices_df = df.loc[:, (slice(None), 'Adj Close')].copy()
         adjusted_prices_df.columns = adjusted_prices_df.columns.droplevel(1)
+        raw_adjusted_prices_df = adjusted_prices_df.copy()
         adjusted_prices_df.ffill(inplace=True)
         
         self.rets_df = adjusted_prices_df.pct_change(fill_method=None)
         self.rets_df = self.rets_df[sorted(self.rets_df.columns)].copy()
         self.adjusted_prices_df = adjusted_prices_df
-        
+
+        # Data from a snapshot has its quality index saved alongside it, so it's only built the first time
+        snapshot_data = bool(self.ticker_hashes) and set(self.ticker_hashes) == set(self.rets_df.columns)
+        self.quality = self.snapshots.load_quality(self.ticker_hashes) if snapshot_data else None
+        if self.quality is None:
+            # Build it here, while we still know which prices were forward filled
+            volume_df = None
+            if 'Volume' in df.columns.get_level_values(1):
+                volume_df = df.loc[:, (slice(None), 'Volume')].copy()
+                volume_df.columns = volume_df.columns.droplevel(1)
+            self.quality = DataQualityIndex.build(self.rets_df, raw_adjusted_prices_df, volume_df)
+            if snapshot_data:
+                self.snapshots.save_quality(self.ticker_hashes, self.quality)
+
         return self.rets_df
 
     def save_data(self, folder_path=DATA_FOLDER) -> None:
@@ -95,6 +116,7 @@ class DataEngine:
         self.rets_df.to_csv(f'{folder_path}rets_df.csv')
         self.adjusted_prices_df.to_csv(f'{folder_path}adjusted_prices_df.csv')
         self.price_df.to_csv(f'{folder_path}price_df.csv')
+        self.quality.save(folder_path)
 
     @staticmethod
     def load_saved_data(folder: str = DATA_FOLDER) -> "DataEngine":
@@ -103,12 +125,29 @@ class DataEngine:
         dblob.adjusted_prices_df = pd.read_csv(f'{folder}adjusted_prices_df.csv', index_col=0, parse_dates=True)
         dblob.price_df = pd.read_csv(f'{folder}price_df.csv', index_col=0, parse_dates=True)
         dblob.price_df.index = pd.to_datetime(dblob.price_df.index)
+        # Older saves won't have a quality index, so just build one (without the forward fill info)
+        dblob.quality = DataQualityIndex.load(folder) or DataQualityIndex.build(dblob.rets_df)
         return dblob
     
     @property
     def tickers(self) -> list[str]:
         return self.rets_df.columns.tolist()
 
+    @property
+    def data_version(self) -> str:
+        '''Fingerprint of the returns data, so anything cached off of it can tell when the data changes.'''
+        return self.tickers_data_version(self.tickers)
+
+    def tickers_data_version(self, tickers: list[str]) -> str:
+        '''Fingerprint of just the given tickers' returns, for results that don't depend on the rest.'''
+        # Data from a snapshot is versioned off the content hashes of just the tickers we're using
+        if self.ticker_hashes and all(ticker in self.ticker_hashes for ticker in tickers):
+            return tickers_version({ticker: self.ticker_hashes[ticker] for ticker in tickers})
+
+        row_hashes = pd.util.hash_pandas_object(self.rets_df[tickers], index=True).to_numpy()
+        col_hash = ','.join(map(str, tickers)).encode()
+        return hashlib.sha256(row_hashes.tobytes() + col_hash).hexdigest()[:16]
+
 if __name__ == '__main__':
     downloader = DataEngine()
     downloader.download_new_data(C.MARKET_TICKERS)
@@ -0,0 +1,199 @@
+import json
+import os
+from dataclasses import dataclass, field
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+QUALITY_FILE = 'data_quality.json'
+STALE_RUN_DAYS = 5  # This many zero returns (or zero volume days) in a row is treated as stale data
+OUTLIER_Z = 12  # Robust z-score above which a daily return is flagged as a suspicious jump
+
+
+@dataclass
+class IntervalSet:
+    '''Sorted, non-overlapping date intervals (inclusive on both ends) that can be queried in O(log n).'''
+
+    starts: np.ndarray = field(default_factory=lambda: np.array([], dtype='datetime64[ns]'))
+    ends: np.ndarray = field(default_factory=lambda: np.array([], dtype='datetime64[ns]'))
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def overlapping(self, start, end) -> list[tuple[pd.Timestamp, pd.Timestamp]]:
+        '''Return the intervals that overlap the [start, end] window.'''
+        start, end = np.datetime64(pd.Timestamp(start), 'ns'), np.datetime64(pd.Timestamp(end), 'ns')
+        # Intervals are sorted and disjoint, so both their starts and ends are increasing
+        lo = np.searchsorted(self.ends, start, side='left')
+        hi = np.searchsorted(self.starts, end, side='right')
+        return [(pd.Timestamp(s), pd.Timestamp(e)) for s, e in zip(self.starts[lo:hi], self.ends[lo:hi])]
+
+    def overlaps(self, start, end) -> bool:
+        start, end = np.datetime64(pd.Timestamp(start), 'ns'), np.datetime64(pd.Timestamp(end), 'ns')
+        return np.searchsorted(self.ends, start, side='left') < np.searchsorted(self.starts, end, side='right')
+
+    def to_dict(self) -> dict:
+        return {'starts': [str(d) for d in self.starts.astype('datetime64[D]')],
+                'ends': [str(d) for d in self.ends.astype('datetime64[D]')]}
+
+    @staticmethod
+    def from_dict(d: dict) -> "IntervalSet":
+        return IntervalSet(np.array(d['starts'], dtype='datetime64[ns]'), np.array(d['ends'], dtype='datetime64[ns]'))
+
+
+@dataclass
+class TickerQuality:
+    '''Everything we know about the quality of one ticker's data.'''
+
+    first_valid: pd.Timestamp | None  # First date with a return
+    last_valid: pd.Timestamp | None  # Last date with a return
+    missing: IntervalSet  # Dates with no return
+    filled: IntervalSet  # Dates where the adjusted price was forward filled
+    stale: IntervalSet  # Runs of zero returns or zero volume
+    outliers: np.ndarray  # Dates with suspicious jumps
+
+    def to_dict(self) -> dict:
+        return {
+            'first_valid': None if self.first_valid is None else str(self.first_valid.date()),
+            'last_valid': None if self.last_valid is None else str(self.last_valid.date()),
+            'missing': self.missing.to_dict(),
+            'filled': self.filled.to_dict(),
+            'stale': self.stale.to_dict(),
+            'outliers': [str(d) for d in self.outliers.astype('datetime64[D]')],
+        }
+
+    @staticmethod
+    def from_dict(d: dict) -> "TickerQuality":
+        return TickerQuality(
+            first_valid=None if d['first_valid'] is None else pd.Timestamp(d['first_valid']),
+            last_valid=None if d['last_valid'] is None else pd.Timestamp(d['last_valid']),
+            missing=IntervalSet.from_dict(d['missing']),
+            filled=IntervalSet.from_dict(d['filled']),
+            stale=IntervalSet.from_dict(d['stale']),
+            outliers=np.array(d['outliers'], dtype='datetime64[ns]'),
+        )
+
+
+def _runs(flags: np.ndarray, dates: np.ndarray, min_length: int = 1) -> list[IntervalSet]:
+    '''Find the runs of True in every column of a boolean matrix in one pass. Returns one IntervalSet per column.'''
+
+    n_cols = flags.shape[1]
+    run_cols, run_starts, run_ends = utils.run_bounds(flags)
+
+    keep = (run_ends - run_starts + 1) >= min_length
+    run_cols, run_starts, run_ends = run_cols[keep], run_starts[keep], run_ends[keep]
+
+    bounds = np.searchsorted(run_cols, np.arange(n_cols + 1))
+    return [
+        IntervalSet(dates[run_starts[bounds[i]:bounds[i + 1]]], dates[run_ends[bounds[i]:bounds[i + 1]]])
+        for i in range(n_cols)
+    ]
+
+
+class DataQualityIndex:
+    '''Per-ticker index of data problems, built once when the data is loaded so that any date window can be
+    validated with a couple of binary searches instead of scanning the returns.'''
+
+    def __init__(self, tickers: dict[str, TickerQuality] = None) -> None:
+        self.tickers: dict[str, TickerQuality] = tickers or {}
+
+    def __getitem__(self, ticker: str) -> TickerQuality:
+        return self.tickers[ticker]
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker in self.tickers
+
+    @staticmethod
+    def build(rets_df: pd.DataFrame, raw_prices_df: pd.DataFrame = None,
+              volume_df: pd.DataFrame = None) -> "DataQualityIndex":
+        '''Build the index from the cleaned returns. raw_prices_df should be the adjusted prices *before* they are
+        forward filled (so we can record what was filled) and volume_df is used to detect zero volume runs.'''
+
+        tickers = rets_df.columns.tolist()
+        dates = rets_df.index.to_numpy(dtype='datetime64[ns]')
+        rets = rets_df.to_numpy(dtype=np.float64)
+        missing = np.isnan(rets)
+
+        has_data = ~missing.all(axis=0)
+        first_pos = np.argmax(~missing, axis=0)
+        last_pos = len(rets) - 1 - np.argmax(~missing[::-1], axis=0)
+
+        missing_runs = _runs(missing, dates)
+
+        if raw_prices_df is not None:
+            raw = raw_prices_df.reindex(index=rets_df.index, columns=tickers).to_numpy(dtype=np.float64)
+            raw_missing = np.isnan(raw)
+            # Only the gaps after the first real price get forward filled
+            raw_missing &= np.maximum.accumulate(~raw_missing, axis=0)
+            filled_runs = _runs(raw_missing, dates)
+        else:
+            filled_runs = [IntervalSet() for _ in tickers]
+
+        stale = rets == 0
+        if volume_df is not None:
+            volume = volume_df.reindex(index=rets_df.index, columns=tickers).to_numpy(dtype=np.float64)
+            stale |= volume == 0
+        stale_runs = _runs(stale, dates, min_length=STALE_RUN_DAYS)
+
+        # Robust z-scores so that one huge jump doesn't hide itself by inflating the standard deviation
+        with np.errstate(invalid='ignore', divide='ignore'):
+            median = np.nanmedian(rets, axis=0) if len(rets) else np.zeros(len(tickers))
+            mad = np.nanmedian(np.abs(rets - median), axis=0) * 1.4826 if len(rets) else np.zeros(len(tickers))
+            z_scores = np.abs(rets - median) / mad
+        outlier_rows, outlier_cols = np.nonzero(np.nan_to_num(z_scores, nan=0, posinf=0) > OUTLIER_Z)
+        order = np.argsort(outlier_cols, kind='stable')
+        outlier_rows, outlier_cols = outlier_rows[order], outlier_cols[order]
+        outlier_bounds = np.searchsorted(outlier_cols, np.arange(len(tickers) + 1))
+
+        index = {}
+        for i, ticker in enumerate(tickers):
+            index[ticker] = TickerQuality(
+                first_valid=pd.Timestamp(dates[first_pos[i]]) if has_data[i] else None,
+                last_valid=pd.Timestamp(dates[last_pos[i]]) if has_data[i] else None,
+                missing=missing_runs[i],
+                filled=filled_runs[i],
+                stale=stale_runs[i],
+                outliers=dates[outlier_rows[outlier_bounds[i]:outlier_bounds[i + 1]]],
+            )
+        return DataQualityIndex(index)
+
+    def missing_tickers(self, tickers: list[str], start, end) -> list[str]:
+        '''Tickers that are missing at least one return in the [start, end] window (or aren't indexed at all).'''
+        return [t for t in tickers if t not in self.tickers or self.tickers[t].missing.overlaps(start, end)]
+
+    def stale_tickers(self, tickers: list[str], start, end) -> list[str]:
+        '''Tickers with a stale run of data somewhere in the [start, end] window.'''
+        return [t for t in tickers if t in self.tickers and self.tickers[t].stale.overlaps(start, end)]
+
+    def outlier_dates(self, ticker: str, start, end) -> np.ndarray:
+        '''Suspicious jump dates for a ticker within the [start, end] window.'''
+        outliers = self.tickers[ticker].outliers
+        lo = np.searchsorted(outliers, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+        hi = np.searchsorted(outliers, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+        return outliers[lo:hi]
+
+    def save(self, folder_path: str) -> None:
+        os.makedirs(folder_path, exist_ok=True)
+        payload = json.dumps({ticker: q.to_dict() for ticker, q in self.tickers.items()})
+        utils.atomic_write(os.path.join(folder_path, QUALITY_FILE), payload.encode())
+
+    @staticmethod
+    def load(folder_path: str) -> "DataQualityIndex | None":
+        file_path = os.path.join(folder_path, QUALITY_FILE)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path) as f:
+            return DataQualityIndex({ticker: TickerQuality.from_dict(d) for ticker, d in json.load(f).items()})
+
+
+if __name__ == '__main__':
+    rets_df = pd.read_csv('data/rets_df.csv', index_col=0, parse_dates=True)
+    quality = DataQualityIndex.build(rets_df)
+
+    # Should agree with the brute force scan
+    start, end = '2012-01-01', '2020-01-01'
+    scan = rets_df.loc[start:end].isnull().sum()
+    assert sorted(quality.missing_tickers(rets_df.columns.tolist(), start, end)) == sorted(scan[scan > 0].index)
+    print(quality['AAPL'].to_dict()['outliers'])
@@ -0,0 +1,141 @@
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+TRADING_DAYS = 252
+DEFAULT_TOP_N = 5
+
+
+@dataclass
+class DrawdownResults:
+    '''Drawdown analytics for every column of a returns matrix.
+
+    underwater holds the drawdown from the running peak on every date (rows) for every column, episodes has one
+    row per drawdown (the deepest top_n per column) and stats has one row per column.
+    '''
+
+    dates: pd.DatetimeIndex
+    columns: list
+    underwater: np.ndarray
+    episodes: pd.DataFrame
+    stats: pd.DataFrame
+
+    def underwater_df(self) -> pd.DataFrame:
+        return pd.DataFrame(self.underwater, index=self.dates, columns=self.columns)
+
+
+def analyze_drawdowns(rets_df: pd.DataFrame, top_n: int = DEFAULT_TOP_N, start_date=None) -> DrawdownResults:
+    '''Compute the underwater curve, the top_n deepest drawdown episodes and summary statistics for every column.
+
+    Everything is a handful of passes over the whole matrix (no per column loop): a cumulative product for the
+    wealth index, a running max for the peaks, one scan for where each drawdown starts and ends, and segmented
+    reductions for the trough of each one. Missing returns are treated as flat days.
+
+    start_date is the date of the starting wealth of 1, before the first return. A drawdown that starts on the
+    first row peaks there, so without a start_date its peak (and durations) are left as NaT / NaN.
+    '''
+
+    dates = pd.DatetimeIndex(rets_df.index)
+    columns = rets_df.columns.tolist()
+    rets = rets_df.to_numpy(dtype=np.float64)
+    n_rows, n_cols = rets.shape
+
+    valid = ~np.isnan(rets)
+    wealth = np.cumprod(np.where(valid, 1 + rets, 1.0), axis=0)
+    # Starting wealth of 1 counts as a peak, so a loss on the first day is a drawdown too
+    peaks = np.maximum.accumulate(np.vstack([np.ones((1, n_cols)), wealth]), axis=0)[1:]
+    underwater = wealth / peaks - 1
+
+    # Every run of days below the prior peak is one drawdown episode
+    in_drawdown = underwater < 0
+    run_cols, run_starts, run_ends = utils.run_bounds(in_drawdown)
+
+    # Find each episode's trough with segmented reductions over the column-major flattened curve
+    flat = np.append(underwater.T.ravel(), 0.0)
+    flat_starts = run_cols * n_rows + run_starts
+    flat_ends = run_cols * n_rows + run_ends + 1
+    bounds = np.empty(2 * len(run_starts), dtype=np.int64)
+    bounds[0::2], bounds[1::2] = flat_starts, flat_ends
+    depths = np.minimum.reduceat(flat, bounds)[0::2] if len(bounds) else np.array([])
+
+    # The trough is the first day in each episode that hits its depth
+    run_lengths = run_ends - run_starts + 1
+    dd_positions = np.flatnonzero(in_drawdown.T.ravel())
+    is_trough = flat[dd_positions] == np.repeat(depths, run_lengths)
+    trough_runs = np.repeat(np.arange(len(run_starts)), run_lengths)[is_trough]
+    troughs = dd_positions[is_trough][np.unique(trough_runs, return_index=True)[1]] - run_cols * n_rows
+
+    recovered = run_ends + 1 < n_rows
+    last = n_rows - 1
+    # The peak is the day before the drawdown starts, or the starting wealth if it starts on the first row
+    start = pd.NaT if start_date is None else pd.Timestamp(start_date)
+    peaks = dates[np.maximum(run_starts - 1, 0)].where(run_starts > 0, start)
+    recovery_rows = np.where(recovered, run_ends + 1, last)
+    durations = (dates[recovery_rows] - peaks).days
+
+    episodes = pd.DataFrame({
+        'Column': np.array(columns, dtype=object)[run_cols] if len(run_cols) else [],
+        'Peak': peaks,
+        'Trough': dates[troughs],
+        'Recovery': dates[recovery_rows].where(recovered),
+        'Depth': depths,
+        'Duration (Days)': durations,
+        'Days to Trough': (dates[troughs] - peaks).days,
+        'Days to Recover': (dates[recovery_rows] - dates[troughs]).days.where(recovered),
+    })
+
+    # Keep the deepest top_n per column
+    ranked = np.lexsort((depths, run_cols))
+    rank_in_col = np.arange(len(ranked)) - np.searchsorted(run_cols[ranked], run_cols[ranked])
+    episodes = episodes.iloc[ranked[rank_in_col < top_n]].reset_index(drop=True)
+
+    # Summary stats
+    n_obs = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cagr = wealth[-1] ** (TRADING_DAYS / n_obs) - 1 if n_rows else np.full(n_cols, np.nan)
+        max_dd = underwater.min(axis=0) if n_rows else np.full(n_cols, np.nan)
+        calmar = np.where(max_dd < 0, cagr / np.abs(max_dd), np.nan)
+    ulcer = np.sqrt(np.mean(underwater ** 2, axis=0)) if n_rows else np.full(n_cols, np.nan)
+    pain = np.mean(np.abs(underwater), axis=0) if n_rows else np.full(n_cols, np.nan)
+    time_underwater = in_drawdown.mean(axis=0) if n_rows else np.full(n_cols, np.nan)
+    longest = np.zeros(n_cols)
+    if len(run_cols):
+        np.fmax.at(longest, run_cols, durations)
+
+    stats = pd.DataFrame({
+        'Max Drawdown': max_dd,
+        'CAGR': cagr,
+        'Calmar': calmar,
+        'Ulcer Index': ulcer,
+        'Pain Index': pain,
+        'Time Underwater': time_underwater,
+        'Longest Drawdown (Days)': longest.astype(int),
+    }, index=columns)
+
+    return DrawdownResults(dates, columns, underwater, episodes, stats)
+
+
+if __name__ == '__main__':
+    import time
+    import metrics
+
+    rets_df = pd.read_csv('data/rets_df.csv', index_col=0, parse_dates=True).loc['2005':]
+    results = analyze_drawdowns(rets_df)
+    brute = rets_df.apply(metrics.get_max_drawdown)
+    print(f"Max drawdown diff vs metrics.get_max_drawdown (SPY): {abs(results.stats.loc['SPY', 'Max Drawdown'] - brute['SPY']):.2e}")
+    print(results.episodes[results.episodes['Column'] == 'SPY'])
+
+    # A loss on the very first day peaks at the starting wealth
+    first_day = analyze_drawdowns(pd.DataFrame({'x': [-0.05, -0.02, 0.10]}, index=pd.date_range('2024-01-02', periods=3)),
+                                  start_date='2024-01-01')
+    assert first_day.episodes.loc[0, 'Peak'] == pd.Timestamp('2024-01-01'), first_day.episodes
+    assert first_day.episodes.loc[0, 'Duration (Days)'] == 3, first_day.episodes
+
+    wide = pd.DataFrame(np.random.default_rng(0).normal(0.0003, 0.01, (7560, 2000)),
+                        index=pd.bdate_range('1995-01-01', periods=7560))
+    t0 = time.time()
+    analyze_drawdowns(wide)
+    print(f'2000 columns x 30 years in {time.time() - t0:.2f}s')
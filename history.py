@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+
+import backtester as bt
+
+
+class SparseHistory:
+    '''Holdings history kept as one snapshot per rebalance instead of one row per day.
+
+    Holdings only change between rebalances by compounding returns, so any day can be rebuilt from the snapshot
+    at the start of its segment and the returns since. The returns are read from the shared returns matrix when
+    needed rather than stored again. Only the daily portfolio totals are kept in full, since everything that
+    depends on the portfolio's returns needs them.
+    '''
+
+    def __init__(self, dates: pd.DatetimeIndex, tickers: list[str], rets_df: pd.DataFrame,
+                 segment_starts: np.ndarray, snapshots: np.ndarray, totals: np.ndarray) -> None:
+        self.dates = dates
+        self.tickers = tickers
+        self.rets_df = rets_df
+        self.segment_starts = segment_starts  # Row (in dates) each snapshot was taken on
+        self.snapshots = snapshots  # Holdings right after each rebalance (the first is the initial allocation)
+        self.totals = totals
+
+        self._ret_cols = rets_df.columns.get_indexer(tickers)
+        self._ret_rows = rets_df.index.get_indexer(dates)  # -1 on days without a return
+
+    @property
+    def nbytes(self) -> int:
+        return self.snapshots.nbytes + self.segment_starts.nbytes + self.totals.nbytes + self._ret_rows.nbytes
+
+    def growth(self, lo: int, hi: int) -> np.ndarray:
+        '''Growth factor of every ticker on each of the rows [lo, hi). Days without a return are flat.'''
+
+        growth = np.ones((hi - lo, len(self.tickers)))
+        rows = self._ret_rows[lo:hi]
+        has_ret = rows >= 0
+        growth[has_ret] += self.rets_df.iloc[rows[has_ret], self._ret_cols].to_numpy(dtype=np.float64)
+        return growth
+
+    def _holdings(self, lo: int, hi: int) -> np.ndarray:
+        '''Holdings on the rows [lo, hi), compounded forward from the snapshot each segment starts with. Seeding
+        the cumprod with the snapshot keeps the multiplication order identical to the day by day engine.'''
+
+        out = np.empty((hi - lo, len(self.tickers)))
+        first = np.searchsorted(self.segment_starts, lo, side='right') - 1
+        last = np.searchsorted(self.segment_starts, hi - 1, side='right') - 1
+        for seg in range(first, last + 1):
+            seg_start = self.segment_starts[seg]
+            seg_end = min(self.segment_starts[seg + 1] if seg + 1 < len(self.segment_starts) else len(self.dates), hi)
+            grown = np.cumprod(np.vstack([self.snapshots[seg], self.growth(seg_start + 1, seg_end)]), axis=0)
+            # Only the part of the segment that falls within [lo, hi)
+            skip = max(lo - seg_start, 0)
+            out[seg_start + skip - lo:seg_end - lo] = grown[skip:]
+        return out
+
+    def _slice(self, start, end) -> tuple[int, int]:
+        lo = 0 if start is None else np.searchsorted(self.dates, pd.Timestamp(start), side='left')
+        hi = len(self.dates) if end is None else np.searchsorted(self.dates, pd.Timestamp(end), side='right')
+        return lo, hi
+
+    def holdings(self, start=None, end=None) -> pd.DataFrame:
+        '''Daily holdings within [start, end] (the whole backtest by default).'''
+
+        lo, hi = self._slice(start, end)
+        return pd.DataFrame(self._holdings(lo, hi), index=self.dates[lo:hi], columns=self.tickers)
+
+    def weights(self, start=None, end=None) -> pd.DataFrame:
+        '''Daily weights within [start, end] (the whole backtest by default).'''
+
+        lo, hi = self._slice(start, end)
+        weights = self._holdings(lo, hi) / self.totals[lo:hi, None]
+        return pd.DataFrame(weights, index=self.dates[lo:hi], columns=self.tickers)
+
+
+class CompactBacktester(bt.Backtester):
+    '''Backtester that keeps a SparseHistory rather than a full size holdings frame.
+
+    Gives exactly the same numbers as Backtester, for plain calendar rebalancing only (drift_band, cash_buffer and
+    cost_bps are rejected). portfolio_history_df and weights_df are still available but are
+    rebuilt each time they are accessed, so for long, wide backtests prefer history.holdings / history.weights
+    on just the dates you need.
+    '''
+
+    pretty_name = 'CompactStrategy'
+    short_name = 'CompactStrat'
+
+    def __init__(
+        self,
+        data_blob,
+        tickers: list[str],
+        weights: list[float],
+        start_date: str,
+        end_date: str,
+        initial_capital: float = 1_000_000,
+        rebal_freq: str = 'QE',
+        port_name: str = 'Port',
+        params: dict = {},
+    ) -> None:
+
+        # No super().__init__: that would allocate the full size history this engine exists to avoid
+        self.rets_df = data_blob.rets_df
+        self.setup(data_blob, tickers, weights, start_date, end_date, initial_capital, rebal_freq, port_name, params)
+        self.require_plain_rebalancing()
+        self.history = None
+
+    def run_backtest(self, verbose=False, progress=None, cancel_event=None) -> None:
+
+        n_days = len(self.strat_dates)
+        target_weights = np.asarray(self.input_weights, dtype=np.float64)
+        # The first day plus every rebalance day starts a new segment
+        segment_starts = np.concatenate([[0], np.flatnonzero(self.strat_dates.isin(self.rebalance_dates))])
+        segment_starts = np.unique(segment_starts)
+        segment_ends = np.append(segment_starts[1:], n_days)
+
+        history = SparseHistory(self.strat_dates, self.input_tickers, self.rets_df, segment_starts,
+                                np.empty((len(segment_starts), len(self.input_tickers))), np.empty(n_days))
+
+        # Allocate the initial capital to the target weights on the first day
+        holdings = target_weights * self.initial_capital
+        for seg, (seg_start, seg_end) in enumerate(zip(segment_starts, segment_ends)):
+            if cancel_event is not None and cancel_event.is_set():
+                raise bt.BacktestCancelled(f'Backtest cancelled at {self.strat_dates[seg_start].date()}')
+            if seg > 0:
+                if verbose:
+                    print(f'Rebalancing: {self.strat_dates[seg_start].date()}')
+                # Compound into the rebalance day itself, then trade back to the targets
+                holdings = target_weights * np.nansum(holdings * history.growth(seg_start, seg_start + 1)[0])
+            history.snapshots[seg] = holdings
+            history.totals[seg_start] = np.nansum(holdings)
+
+            # Only one segment of daily holdings is ever in memory
+            segment = np.cumprod(np.vstack([holdings, history.growth(seg_start + 1, seg_end)]), axis=0)[1:]
+            history.totals[seg_start + 1:seg_end] = np.nansum(segment, axis=1)
+            if len(segment):
+                holdings = segment[-1]
+
+            self.current_date = self.strat_dates[seg_end - 1]
+            if progress is not None:
+                progress(seg_end, n_days)
+
+        self.history = history
+        self.portfolio = pd.Series(holdings, index=self.input_tickers, name=self.port_name)
+        self.calculate_data()
+
+    def calculate_data(self) -> None:
+        '''Same outputs as Backtester.calculate_data, built from the daily totals alone.'''
+
+        self.total_port_values = pd.Series(self.history.totals, index=self.strat_dates, name=self.port_name)
+        self.calculate_port_returns()
+
+    @property
+    def portfolio_history_df(self) -> pd.DataFrame:
+        return self.history.holdings()
+
+    @property
+    def weights_df(self) -> pd.DataFrame:
+        return self.history.weights()
+
+
+if __name__ == '__main__':
+    import time
+    import data_engine as dd
+
+    data = dd.DataEngine.load_saved_data('data/')
+    args = dict(tickers=['AAPL', 'MSFT', 'SPY'], weights=[0.3, 0.3, 0.4], start_date='2005-01-01',
+                end_date='2020-01-01', rebal_freq='ME')
+    full = bt.Backtester(data_blob=data, **args)
+    full.run_backtest()
+    compact = CompactBacktester(data_blob=data, **args)
+    compact.run_backtest()
+
+    diff = (full.portfolio_history_df.astype(float) - compact.portfolio_history_df).abs().max().max()
+    print(f'Max holding diff vs full engine: {diff}')
+    print(f'Max weight diff vs full engine: {(full.weights_df - compact.weights_df).abs().max().max()}')
+    print(f"Slice diff: {(full.weights_df.loc['2012-02-10':'2012-05-03'] - compact.history.weights('2012-02-10', '2012-05-03')).abs().max().max()}")
+
+    wide = data.rets_df.columns[:200].tolist()
+    wide_args = dict(tickers=wide, weights=[1 / len(wide)] * len(wide), start_date='1995-01-01', end_date='2024-12-31')
+    t0 = time.time()
+    compact = CompactBacktester(data_blob=data, **wide_args)
+    compact.run_backtest()
+    print(f'{len(wide)} tickers x 30 years in {time.time() - t0:.2f}s, history takes {compact.history.nbytes / 1e6:.2f}MB '
+          f'vs {len(compact.strat_dates) * len(wide) * 8 / 1e6:.0f}MB for the full holdings')
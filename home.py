@@ -1,3 +1,5 @@
+import os
+import time
 import pandas as pd
 import streamlit as st
 import plotly.express as px
@@ -7,6 +9,26 @@ import inputs
 import data_engine as dd
 import backtester as bt
 import results as rs
+import result_store
+import service
+import universes
+import jobs
+
+# If set, run against a shared backtest service (see service.py) instead of doing everything in this session
+SERVICE_URL = os.environ.get('BACKTEST_SERVICE_URL')
+PROGRESS_POLL_SECONDS = 0.2
+UNIVERSE_REFRESH_SECONDS = 300  # How often we look for universes that have been (re)built by another process
+
+
+@st.cache_resource(ttl=UNIVERSE_REFRESH_SECONDS)
+def universe_registry() -> universes.UniverseRegistry:
+    return universes.UniverseRegistry()
+
+
+@st.cache_resource(max_entries=8)
+def universe_data(folder: str) -> dd.DataEngine:
+    # Builds never change once written, so the engine for one can be shared by every session
+    return universes.Universe(folder).as_data_engine()
 
 st.title("Portfolio Backtester")
 html_title = """
@@ -20,7 +42,9 @@ st.sidebar.markdown("""
 - [Results](#results)
   - [Cumulative Returns](#cumulative-returns)
   - [Volatility](#volatility)    
+  - [Drawdowns](#drawdowns)
   - [Performance Metrics](#performance-metrics)                
+  - [Factor Regression](#factor-regression)
   - [Correlation Matrix](#correlation-matrix)                                        
   - [Portfolio Weights Over Time](#portfolio-weights-over-time)
   - [Individual Prices](#individual-prices)
@@ -46,7 +70,7 @@ cleaned_inputs = inputs.get_user_inputs()
 # Fetch Market Data & Validate against Inputs
 # ----------------------------
 
-needed_tickers = list(dict.fromkeys(cleaned_inputs.tickers + [cleaned_inputs.bench_ticker]))
+needed_tickers = list(dict.fromkeys(cleaned_inputs.tickers + [cleaned_inputs.bench_ticker] + cleaned_inputs.factor_tickers))
 
 
 # Need to uncomment out below in a bit
@@ -54,61 +78,124 @@ needed_tickers = list(dict.fromkeys(cleaned_inputs.tickers + [cleaned_inputs.ben
 #     st.stop()
 
 
-with st.spinner("Fetching data..."):
-    data = dd.DataEngine()
-    
-    # Try loading cached data first
-    data.raw_data_df = data.load_local_data(needed_tickers)
-    
-    # May need to review below to fetch data for any new tickers
-    if data.raw_data_df is None or cleaned_inputs.fetch_new_data:
-        # st.warning("Fetching new data from Yahoo Finance. This may take a second...")
-        with st.spinner("Fetching new data from Yahoo Finance. This may take a second..."):
-            data.download_new_data(needed_tickers)
-    
-    # Make sure it's been cleaned
-    data.clean_data()
-
-
-# Validate we have the data to run a backtest
-# Ensure selected tickers exist in dataset (Should be moved somewhere else???)
-missing_tickers = [t for t in cleaned_inputs.tickers if t not in data.tickers]
-if missing_tickers:
-    error_msg = f"""Missing data for some tickers. Sorry... If you want to fetch new data, toggle the buttom
+backtest_spec = dict(
+    tickers=cleaned_inputs.tickers,
+    weights=cleaned_inputs.weights,
+    start_date=str(cleaned_inputs.start_date),
+    end_date=str(cleaned_inputs.end_date),
+    rebal_freq=cleaned_inputs.rebalance_freq,
+)
+
+if SERVICE_URL:
+    # Thin client: the shared backtest service holds the data and runs the backtest
+    client = service.BacktestClient(SERVICE_URL)
+    try:
+        with st.spinner("Running backtest..."):
+            data = client.get_data(needed_tickers, cleaned_inputs.start_date, cleaned_inputs.end_date)
+            backtester = client.run_backtest(backtest_spec)
+    except service.ServiceBusy:
+        st.error("The backtest service is busy right now. Please try again in a moment.")
+        st.stop()
+    except ValueError as e:
+        st.error(f"Sorry... {e}")
+        st.stop()
+    store = result_key = None
+
+else:
+    # A prebuilt universe (see universes.py) that covers every ticker over the whole period already has aligned,
+    # gap free matrices, so there is nothing to load, clean or validate
+    universe = None
+    if not cleaned_inputs.fetch_new_data:
+        universe = universe_registry().find(needed_tickers, cleaned_inputs.start_date, cleaned_inputs.end_date)
+
+    if universe is not None:
+        data = universe_data(universe.folder)
+    else:
+        with st.spinner("Fetching data..."):
+            data = dd.DataEngine()
+
+            # Try loading cached data first
+            data.raw_data_df = data.load_local_data(needed_tickers)
+
+            # May need to review below to fetch data for any new tickers
+            if data.raw_data_df is None or cleaned_inputs.fetch_new_data:
+                # st.warning("Fetching new data from Yahoo Finance. This may take a second...")
+                with st.spinner("Fetching new data from Yahoo Finance. This may take a second..."):
+                    # Cleans the data as well
+                    data.download_new_data(needed_tickers)
+            else:
+                data.clean_data()
+
+
+        # Validate we have the data to run a backtest
+        # Ensure selected tickers exist in dataset (Should be moved somewhere else???)
+        missing_tickers = [t for t in cleaned_inputs.tickers if t not in data.tickers]
+        if missing_tickers:
+            error_msg = f"""Missing data for some tickers. Sorry... If you want to fetch new data, toggle the buttom
 \n Missing tickers: {missing_tickers}"""
-    st.error(error_msg)
-    st.stop()
-
-
-# Filter returns dataframe for only the selected tickers
-data.rets_df = data.rets_df[needed_tickers].copy()
-
-
-
-# Check that we have returns for all tickers for the entire backtest period
-missing_returns = data.rets_df.loc[cleaned_inputs.start_date:cleaned_inputs.end_date].isnull().sum()
-if missing_returns.any():
-    error_msg = f"""Missing returns for some tickers during the backtest period. Sorry... 
-\n Problem tickers: {missing_returns[missing_returns > 0].index.tolist()}"""
-    st.error(error_msg)
-    st.stop()
-
-
-
-# ----------------------------
-# Run Backtest
-# ----------------------------
-
-with st.spinner("Running backtest..."):
-    backtester = bt.Backtester(
-        data_blob=data,
-        tickers=cleaned_inputs.tickers,
-        weights=cleaned_inputs.weights,
-        start_date=str(cleaned_inputs.start_date),
-        end_date=str(cleaned_inputs.end_date),
-        rebal_freq=cleaned_inputs.rebalance_freq,
-    )
-    backtester.run_backtest()
+            st.error(error_msg)
+            st.stop()
+
+
+        # Filter returns dataframe for only the selected tickers
+        data.rets_df = data.rets_df[needed_tickers].copy()
+
+
+
+        # Check that we have returns for all tickers for the entire backtest period
+        missing_returns = data.quality.missing_tickers(needed_tickers, cleaned_inputs.start_date, cleaned_inputs.end_date)
+        if missing_returns:
+            error_msg = f"""Missing returns for some tickers during the backtest period. Sorry... 
+\n Problem tickers: {missing_returns}"""
+            st.error(error_msg)
+            st.stop()
+
+    # Stale data isn't fatal, but worth pointing out
+    if data.quality is not None:
+        stale_tickers = data.quality.stale_tickers(needed_tickers, cleaned_inputs.start_date, cleaned_inputs.end_date)
+        if stale_tickers:
+            st.warning(f"Some tickers have runs of unchanged prices or zero volume during the backtest period: {stale_tickers}")
+
+
+    # ----------------------------
+    # Run Backtest
+    # ----------------------------
+
+    # Identical runs on identical data come straight out of the result store (shared with the backtest service)
+    store = result_store.ResultStore()
+    result_key = result_store.backtest_key(backtest_spec, data)
+    backtester = store.load(result_key)
+
+    # A background run is only wanted for inputs that aren't stored yet. One for inputs that have since changed (or
+    # that another session has stored in the meantime) is cancelled and dropped.
+    job = st.session_state.get('backtest_job')
+    if job is not None and (job.key != result_key or backtester is not None):
+        job.cancel()
+        del st.session_state['backtest_job']
+        job = None
+
+    if backtester is None:
+        # Run in the background so we can show progress
+        if job is None:
+            # The kernel engine reads a universe's matrices directly, rather than looking up every day by label
+            engine = 'python' if universe is None else 'kernel'
+            job = jobs.BacktestJob(result_key, bt.Backtester(data_blob=data, engine=engine, **backtest_spec))
+            st.session_state['backtest_job'] = job
+
+        progress_bar = st.progress(0.0, text="Running backtest...")
+        while not job.done():
+            progress_bar.progress(job.fraction, text=f"Running backtest... {job.days_done:,} of {job.days_total:,} days simulated")
+            time.sleep(PROGRESS_POLL_SECONDS)
+        progress_bar.empty()
+        try:
+            backtester = job.result()
+        except Exception as e:
+            # Forget the failed (or cancelled) run, otherwise every rerun with these inputs would just re-raise it
+            st.session_state.pop('backtest_job', None)
+            if isinstance(e, ValueError):
+                st.error(f"Sorry... {e}")
+                st.stop()
+            raise
 
 # ----------------------------
 # Display Results
@@ -118,4 +205,16 @@ with st.spinner("Running backtest..."):
 st.markdown("---")
 st.markdown("## Results")
 
-rs.display_results(backtester, data, cleaned_inputs)
+sections_bar = st.progress(0.0, text="Preparing results...")
+rs.display_results(
+    backtester, data, cleaned_inputs,
+    executor=jobs.ANALYTICS_EXECUTOR,
+    progress=lambda ready, total: sections_bar.progress(ready / total, text=f"{ready} of {total} sections ready"),
+)
+sections_bar.empty()
+
+if store is not None:
+    if result_key not in store:
+        store.save(result_key, backtester, backtest_spec)
+    # The result is in the store now, so the finished job (and the backtest it holds) can go
+    st.session_state.pop('backtest_job', None)
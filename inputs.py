@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import pandas as pd
 import streamlit as st
 import plotly.express as px
@@ -20,6 +20,7 @@ class CleanInputs:
     rebalance_freq: str
     bench_ticker: str
     fetch_new_data: bool = False
+    factor_tickers: list = field(default_factory=list)
 
 
 
@@ -156,6 +157,12 @@ def get_user_inputs():
         index=0
     )
 
+    factor_tickers = st.multiselect(
+        "Optionally, pick more benchmarks / factors to regress the portfolio against (alongside the benchmark):",
+        [t for t in dict.fromkeys(C.MARKET_TICKERS + C.FI_TICKERS + C.SECTOR_TICKERS) if t != benchmark],
+        default=[],
+    )
+
 
 
     # ------------------
@@ -180,6 +187,7 @@ def get_user_inputs():
         port_name=port_name,
         rebalance_freq=rebalance_freq,
         bench_ticker=benchmark,
+        factor_tickers=factor_tickers,
         fetch_new_data=fetch_new_data
     )
     return clean_inputs
\ No newline at end of file
@@ -0,0 +1,44 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import backtester as bt
+
+
+# Shared by every Streamlit session in the process. Backtests and results analytics get separate pools so a few
+# long backtests can't hold up the charts of a run that has already finished.
+BACKTEST_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='backtest')
+ANALYTICS_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='analytics')
+
+
+class BacktestJob:
+    '''A backtest running in the background, so the page can show progress while it runs and drop it when the
+    inputs change.'''
+
+    def __init__(self, key: str, backtest: bt.Backtester) -> None:
+        self.key = key
+        self.backtest = backtest
+        self.days_done = 0
+        self.days_total = len(backtest.strat_dates)
+        self.cancel_event = threading.Event()
+        self.future = BACKTEST_EXECUTOR.submit(
+            backtest.run_backtest, progress=self._on_progress, cancel_event=self.cancel_event
+        )
+
+    def _on_progress(self, days_done: int, days_total: int) -> None:
+        self.days_done, self.days_total = days_done, days_total
+
+    @property
+    def fraction(self) -> float:
+        return min(self.days_done / max(self.days_total, 1), 1.0)
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+        self.future.cancel()
+
+    def result(self) -> bt.Backtester:
+        '''Wait for the backtest to finish and return it. Re-raises anything the backtest raised.'''
+        self.future.result()
+        return self.backtest
@@ -0,0 +1,118 @@
+import numpy as np
+
+# Numba is optional. Without it the same rules run through a NumPy version that steps through the days in Python
+# but does each day's work across all tickers at once.
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def _simulate_loop(growth, target_weights, is_rebal_day, initial_capital, drift_band, cash_buffer, cost_rate,
+                   holdings, cash, turnover):
+    '''Plain loops over days and tickers, written to be compiled by numba. Fills holdings, cash and turnover.'''
+
+    n_days, n_tickers = growth.shape
+    current = np.zeros(n_tickers)
+    cash_now = initial_capital
+
+    for t in range(n_days):
+        if t > 0:
+            for j in range(n_tickers):
+                current[j] *= growth[t, j]
+
+        value = cash_now
+        for j in range(n_tickers):
+            if not np.isnan(current[j]):
+                value += current[j]
+
+        rebalance = t == 0 or is_rebal_day[t]
+        if rebalance and t > 0 and drift_band > 0:
+            # Only trade if some weight has drifted outside the band around its target
+            drift = 0.0
+            for j in range(n_tickers):
+                d = abs(current[j] / value - target_weights[j] * (1 - cash_buffer))
+                if d > drift:
+                    drift = d
+            rebalance = drift > drift_band
+
+        if rebalance:
+            invested = value * (1 - cash_buffer)
+            traded = 0.0
+            for j in range(n_tickers):
+                old = 0.0 if np.isnan(current[j]) else current[j]
+                traded += abs(target_weights[j] * invested - old)
+            turnover[t] = traded / value
+            # Costs come out of the portfolio before it is split between the targets and the cash buffer
+            value -= traded * cost_rate
+            invested = value * (1 - cash_buffer)
+            for j in range(n_tickers):
+                current[j] = target_weights[j] * invested
+            cash_now = value - invested
+
+        for j in range(n_tickers):
+            holdings[t, j] = current[j]
+        cash[t] = cash_now
+
+
+_simulate_compiled = numba.njit(cache=True)(_simulate_loop) if HAS_NUMBA else None
+
+
+def _simulate_numpy(growth, target_weights, is_rebal_day, initial_capital, drift_band, cash_buffer, cost_rate,
+                    holdings, cash, turnover):
+    '''Same rules as _simulate_loop, one NumPy row operation per day.'''
+
+    current = np.zeros(growth.shape[1])
+    cash_now = initial_capital
+    target_invested = target_weights * (1 - cash_buffer)
+
+    for t in range(len(growth)):
+        if t > 0:
+            current *= growth[t]
+        value = cash_now + np.nansum(current)
+
+        rebalance = t == 0 or is_rebal_day[t]
+        if rebalance and t > 0 and drift_band > 0:
+            rebalance = np.nanmax(np.abs(current / value - target_invested), initial=0.0) > drift_band
+
+        if rebalance:
+            traded = np.abs(target_weights * (value * (1 - cash_buffer)) - np.nan_to_num(current)).sum()
+            turnover[t] = traded / value
+            value -= traded * cost_rate
+            invested = value * (1 - cash_buffer)
+            current = target_weights * invested
+            cash_now = value - invested
+
+        holdings[t] = current
+        cash[t] = cash_now
+
+
+def simulate(growth: np.ndarray, target_weights: np.ndarray, is_rebal_day: np.ndarray, initial_capital: float,
+             drift_band: float = 0.0, cash_buffer: float = 0.0, cost_bps: float = 0.0,
+             use_numba: bool = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Simulate a fixed weight portfolio with path-dependent rebalancing rules.
+
+    growth is (days, tickers) of 1 + return (1 on days without a return). The capital is allocated on day 0, and
+    on every is_rebal_day the portfolio is traded back to target_weights, unless drift_band is set and no weight
+    has moved more than drift_band from its target. cash_buffer is the fraction of the portfolio left in cash at
+    each rebalance, and cost_bps is charged on the value traded.
+
+    Returns the holdings (days, tickers), the cash held on each day and each day's turnover (value traded as a
+    fraction of the portfolio, 0 on days without trades).
+    '''
+
+    growth = np.ascontiguousarray(growth, dtype=np.float64)
+    target_weights = np.ascontiguousarray(target_weights, dtype=np.float64)
+    is_rebal_day = np.ascontiguousarray(is_rebal_day, dtype=np.bool_)
+    holdings = np.empty_like(growth)
+    cash = np.empty(len(growth))
+    turnover = np.zeros(len(growth))
+
+    use_numba = HAS_NUMBA if use_numba is None else use_numba
+    if use_numba and not HAS_NUMBA:
+        raise ImportError('numba is not installed.')
+    kernel = _simulate_compiled if use_numba else _simulate_numpy
+    kernel(growth, target_weights, is_rebal_day, float(initial_capital), float(drift_band), float(cash_buffer),
+           float(cost_bps) / 10_000, holdings, cash, turnover)
+    return holdings, cash, turnover
@@ -0,0 +1,201 @@
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+
+
+TRADING_DAYS = 252
+
+
+@dataclass
+class RegressionResults:
+    '''OLS of every portfolio on the same set of factors. Frames are indexed by factor (or benchmark) with one
+    column per portfolio. Alpha and the volatilities are annualized.'''
+
+    alpha: pd.Series
+    betas: pd.DataFrame
+    alpha_t: pd.Series
+    beta_t: pd.DataFrame
+    r_squared: pd.Series
+    residual_vol: pd.Series
+    tracking_error: pd.DataFrame
+    n_obs: pd.Series
+
+    def summary(self) -> pd.DataFrame:
+        '''One row per portfolio with every statistic side by side.'''
+        parts = {
+            'Alpha': self.alpha,
+            'Alpha t-stat': self.alpha_t,
+            **{f'Beta ({f})': self.betas.loc[f] for f in self.betas.index},
+            **{f'Beta t-stat ({f})': self.beta_t.loc[f] for f in self.beta_t.index},
+            'R-Squared': self.r_squared,
+            'Residual Vol': self.residual_vol,
+            **{f'Tracking Error ({f})': self.tracking_error.loc[f] for f in self.tracking_error.index},
+            'Observations': self.n_obs,
+        }
+        return pd.DataFrame(parts)
+
+
+def _prepare(rets_df: pd.DataFrame, factors_df: pd.DataFrame):
+    '''Align the portfolios and factors on date and build the design matrix (with a constant) plus a weight matrix
+    marking, for each portfolio, which dates it can use.'''
+
+    rets_df, factors_df = rets_df.align(factors_df, join='inner', axis=0)
+    y = rets_df.to_numpy(dtype=np.float64)
+    f = factors_df.to_numpy(dtype=np.float64)
+    x = np.column_stack([np.ones(len(f)), f])
+
+    # A date counts for a portfolio if the portfolio and every factor have a return on it
+    weights = (~np.isnan(y) & ~np.isnan(x).any(axis=1, keepdims=True)).astype(np.float64)
+    x = np.nan_to_num(x)
+    y = np.nan_to_num(y)
+    return rets_df, factors_df, x, y, weights
+
+
+def _moments(x: np.ndarray, y: np.ndarray, weights: np.ndarray) -> list[np.ndarray]:
+    '''Weighted sufficient statistics for every portfolio at once: X'X (m or 1, p, p), X'y (m, p), y'y, sum(y)
+    and the observation count (each (m,)). All done as matrix products, so it runs through BLAS.'''
+
+    p = x.shape[1]
+    outer = (x[:, :, None] * x[:, None, :]).reshape(len(x), p * p)
+    wy = weights * y
+    # Usually every portfolio uses the same dates, in which case X'X is shared and comes back with shape (1, p, p)
+    shared = weights.shape[1] > 0 and bool((weights == weights[:, :1]).all())
+    return [
+        ((weights[:, :1] if shared else weights).T @ outer).reshape(-1, p, p),
+        wy.T @ x,
+        np.einsum('nm,nm->m', wy, y),
+        wy.sum(axis=0),
+        weights.sum(axis=0),
+    ]
+
+
+def _solve(xtx: np.ndarray, xty: np.ndarray, syy: np.ndarray, sy: np.ndarray, n: np.ndarray,
+           t_stats: bool = True):
+    '''Turn the (per portfolio) sufficient statistics into coefficients, t-stats, R-squared and residual variance.'''
+
+    p = xtx.shape[-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        try:
+            xtx_inv = np.linalg.inv(xtx)
+        except np.linalg.LinAlgError:
+            # Some portfolio doesn't have enough data (or the factors are collinear). Slower, but always works.
+            xtx_inv = np.linalg.pinv(xtx)
+        coefs = (xtx_inv @ xty[:, :, None])[:, :, 0]
+        # SSE = y'y - 2 b'X'y + b'X'X b, which for the OLS solution reduces to y'y - b'X'y
+        sse = np.maximum(syy - np.einsum('mi,mi->m', coefs, xty), 0)
+        dof = n - p
+        sigma2 = np.where(dof > 0, sse / dof, np.nan)
+        t = coefs / np.sqrt(sigma2[:, None] * np.diagonal(xtx_inv, axis1=1, axis2=2)) if t_stats else None
+        sst = syy - sy ** 2 / n
+        r_squared = 1 - sse / sst
+    return coefs, t, r_squared, sigma2
+
+
+def regress(rets_df: pd.DataFrame, factors_df: pd.DataFrame) -> RegressionResults:
+    '''Regress every column of rets_df on all the columns of factors_df (plus a constant) in one batched solve.
+
+    Each portfolio uses all the dates where it and every factor have returns, so portfolios with different
+    histories can be fit together. The X'X and X'y sums for every portfolio come out of a couple of matrix
+    products and are then solved together, rather than fitting one model at a time.
+    '''
+
+    rets_df, factors_df, x, y, weights = _prepare(rets_df, factors_df)
+
+    xtx, xty, syy, sy, n = _moments(x, y, weights)
+    coefs, t_stats, r_squared, sigma2 = _solve(xtx, xty, syy, sy, n)
+
+    # Tracking error of every portfolio against every factor, on the same dates used in the fit. The sums needed
+    # for var(y - f) are already sitting in X'X and X'y, so no need to build the differences.
+    sum_diff_sq = syy[:, None] - 2 * xty[:, 1:] + np.diagonal(xtx, axis1=1, axis2=2)[:, 1:]
+    sum_diff = sy[:, None] - xtx[:, 0, 1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        te_var = (sum_diff_sq - sum_diff ** 2 / n[:, None]) / (n[:, None] - 1)
+    tracking_error = np.sqrt(np.maximum(te_var, 0)).T * np.sqrt(TRADING_DAYS)
+
+    portfolios, factors = rets_df.columns, factors_df.columns
+    return RegressionResults(
+        alpha=pd.Series(coefs[:, 0] * TRADING_DAYS, index=portfolios),
+        betas=pd.DataFrame(coefs[:, 1:].T, index=factors, columns=portfolios),
+        alpha_t=pd.Series(t_stats[:, 0], index=portfolios),
+        beta_t=pd.DataFrame(t_stats[:, 1:].T, index=factors, columns=portfolios),
+        r_squared=pd.Series(r_squared, index=portfolios),
+        residual_vol=pd.Series(np.sqrt(sigma2 * TRADING_DAYS), index=portfolios),
+        tracking_error=pd.DataFrame(tracking_error, index=factors, columns=portfolios),
+        n_obs=pd.Series(n.astype(int), index=portfolios),
+    )
+
+
+def rolling_regress(rets_df: pd.DataFrame, factors_df: pd.DataFrame, window: int = TRADING_DAYS,
+                    step: int = 1, min_obs: int = None) -> dict[str, pd.DataFrame]:
+    '''Rolling version of regress. The X'X and X'y sums are updated incrementally (add the days entering the
+    window, subtract the ones leaving it) instead of refitting each window from scratch, and the fit is solved
+    every step days. Windows where a portfolio has fewer than min_obs observations (half the window by default)
+    come back as NaN.
+
+    Returns a dict of frames indexed by date with one column per portfolio: 'alpha', 'r_squared', and
+    'beta (<factor>)' for each factor.
+    '''
+
+    rets_df, factors_df, x, y, weights = _prepare(rets_df, factors_df)
+    n_days, p = len(x), x.shape[1]
+    min_obs = max(window // 2 if min_obs is None else min_obs, p + 1)
+
+    state = None
+    added, removed = 0, 0  # The window currently covers rows [removed, added)
+    out_dates, out_coefs, out_r2 = [], [], []
+    for t in range(window - 1, n_days, step):
+        # Add the rows that entered the window since the last fit and drop the ones that left it
+        entering = _moments(x[added:t + 1], y[added:t + 1], weights[added:t + 1])
+        leaving = _moments(x[removed:t + 1 - window], y[removed:t + 1 - window], weights[removed:t + 1 - window])
+        if state is None:
+            state = [e - l for e, l in zip(entering, leaving)]
+        else:
+            state = [s + e - l for s, e, l in zip(state, entering, leaving)]
+        added, removed = t + 1, t + 1 - window
+
+        xtx, xty, syy, sy, n = state
+        coefs, _, r_squared, _ = _solve(xtx, xty, syy, sy, n, t_stats=False)
+        # Windows without enough data for a fit come back empty
+        coefs[n < min_obs] = np.nan
+        r_squared[n < min_obs] = np.nan
+        out_dates.append(rets_df.index[t])
+        out_coefs.append(coefs)
+        out_r2.append(r_squared)
+
+    if not out_dates:
+        empty = pd.DataFrame(columns=rets_df.columns, dtype=float)
+        return {'alpha': empty, 'r_squared': empty, **{f'beta ({f})': empty for f in factors_df.columns}}
+
+    coefs = np.stack(out_coefs)
+    index = pd.DatetimeIndex(out_dates)
+    results = {
+        'alpha': pd.DataFrame(coefs[:, :, 0] * TRADING_DAYS, index=index, columns=rets_df.columns),
+        'r_squared': pd.DataFrame(np.stack(out_r2), index=index, columns=rets_df.columns),
+    }
+    for i, factor in enumerate(factors_df.columns, start=1):
+        results[f'beta ({factor})'] = pd.DataFrame(coefs[:, :, i], index=index, columns=rets_df.columns)
+    return results
+
+
+if __name__ == '__main__':
+    import time
+    import statsmodels.api as sm
+
+    rets_df = pd.read_csv('data/rets_df.csv', index_col=0, parse_dates=True).loc['2016':]
+    factors = ['SPY', 'IWM', 'AGG']
+    portfolios = rets_df.drop(columns=factors)
+
+    batched = regress(portfolios, rets_df[factors])
+    model = sm.OLS(portfolios['AAPL'], sm.add_constant(rets_df[factors]), missing='drop').fit()
+    print(f"AAPL beta diff vs statsmodels: {np.abs(batched.betas['AAPL'].to_numpy() - model.params[factors].to_numpy()).max():.2e}")
+    print(f"AAPL t-stat diff vs statsmodels: {np.abs(batched.beta_t['AAPL'].to_numpy() - model.tvalues[factors].to_numpy()).max():.2e}")
+
+    rng = np.random.default_rng(0)
+    wide = pd.DataFrame(rng.normal(0, 0.01, (2520, 500)), index=pd.bdate_range('2010-01-01', periods=2520))
+    wide_factors = pd.DataFrame(rng.normal(0, 0.01, (2520, 30)), index=wide.index)
+    t0 = time.time()
+    regress(wide, wide_factors)
+    print(f'500 portfolios x 30 factors in {time.time() - t0:.2f}s')
+    t0 = time.time()
+    rolling_regress(wide, wide_factors, step=21)
+    print(f'Rolling (monthly steps) in {time.time() - t0:.2f}s')
@@ -0,0 +1,234 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+import backtester as bt
+import utils
+
+
+RESULTS_FOLDER = 'temp_results/'
+MAX_STORE_BYTES = 1_000_000_000  # Least recently used results are evicted past this size
+MAX_STORE_ENTRIES = 1_000
+
+
+# The spec fields a backtest's outputs depend on, with Backtester's defaults for any that are left out
+KEY_DEFAULTS = {'rebal_freq': 'QE', 'initial_capital': 1_000_000, 'params': {}}
+KEY_FIELDS = ['tickers', 'weights', 'start_date', 'end_date', *KEY_DEFAULTS]
+
+
+def spec_key(spec: dict, data_version: str) -> str:
+    '''Content hash for a backtest: the same strategy spec run on the same data always gets the same key.'''
+    payload = json.dumps({'spec': spec, 'data_version': data_version}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def backtest_key(spec: dict, data_blob) -> str:
+    '''The key to store a backtest of spec on data_blob under. Everything that saves or looks up results (the app,
+    the service, batch jobs) should use this, so identical runs share one entry.
+
+    Only the backtest inputs and the returns of its own tickers within its own dates go in, so changes to any
+    other ticker's data (or outside the window) don't invalidate it. Days on which none of the tickers moved
+    can't change the result, so they are left out too. That way data loaded alongside different tickers (and so
+    with a different set of dates) still gives the same key.
+    '''
+
+    inputs = {**KEY_DEFAULTS, **{field: spec[field] for field in KEY_FIELDS if field in spec}}
+    inputs['tickers'] = list(inputs['tickers'])
+    inputs['weights'] = [float(w) for w in inputs['weights']]
+    inputs['start_date'] = str(pd.Timestamp(inputs['start_date']).date())
+    inputs['end_date'] = str(pd.Timestamp(inputs['end_date']).date())
+
+    rets_df = data_blob.rets_df.loc[inputs['start_date']:inputs['end_date'], inputs['tickers']]
+    rets_df = rets_df[(rets_df != 0).any(axis=1)]
+    # Hash the raw values, so the resolution of the dates or the kind of NaN doesn't change the key
+    dates = rets_df.index.to_numpy(dtype='datetime64[ns]')
+    rets = np.array(rets_df.to_numpy(dtype=np.float64), order='C')
+    rets[np.isnan(rets)] = np.nan
+    return spec_key(inputs, hashlib.sha256(dates.tobytes() + rets.tobytes()).hexdigest()[:16])
+
+
+class BacktestResult(bt.Backtester):
+    '''A backtest that has already been run, rebuilt from the result store. Has all the same outputs as a
+    Backtester after run_backtest, so it can be handed straight to results.display_results. Any cash buffer is
+    already in the history (as a Cash column) and costs are already in the holdings, so the rebalancing params just
+    come along for reference. turnover is None for results stored before it was saved.'''
+
+    def __init__(self, portfolio_history_df: pd.DataFrame, rebalance_dates: pd.DatetimeIndex, spec: dict,
+                 turnover: pd.Series = None) -> None:
+        self.portfolio_history_df = portfolio_history_df
+        self.rebalance_dates = rebalance_dates
+        self.strat_dates = portfolio_history_df.index
+        self.input_tickers = [t for t in portfolio_history_df.columns if t != 'Cash']
+        self.input_weights = spec.get('weights')
+        self.port_name = spec.get('port_name', 'Port')
+        self.start_date = spec.get('start_date')
+        self.end_date = spec.get('end_date')
+        self.current_date = self.end_date
+        self.params = spec.get('params', {})
+        self.drift_band = self.params.get('drift_band', 0.0)
+        self.cash_buffer = self.params.get('cash_buffer', 0.0)
+        self.cost_bps = self.params.get('cost_bps', 0.0)
+        self.turnover = turnover
+        self.calculate_data()
+
+    def run_backtest(self, verbose=False, progress=None, cancel_event=None) -> None:
+        pass
+
+
+def pack_result(backtest: bt.Backtester) -> bytes:
+    '''Serialize the outputs of a finished backtest to compressed .npz bytes. Everything else is derived from these.'''
+
+    history = backtest.portfolio_history_df
+    turnover = getattr(backtest, 'turnover', None)
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        **({} if turnover is None else {'turnover': turnover.to_numpy(dtype=np.float64)}),
+        history=history.to_numpy(dtype=np.float64),
+        dates=history.index.to_numpy(dtype='datetime64[ns]').astype(np.int64),
+        tickers=np.array(history.columns.tolist()),
+        rebalance_dates=pd.DatetimeIndex(backtest.rebalance_dates).to_numpy(dtype='datetime64[ns]').astype(np.int64),
+    )
+    return buffer.getvalue()
+
+
+def unpack_result(data: bytes, spec: dict) -> BacktestResult:
+    '''Rebuild a backtest from the bytes written by pack_result.'''
+
+    with np.load(io.BytesIO(data)) as npz:
+        dates = pd.DatetimeIndex(npz['dates'].astype('datetime64[ns]'))
+        history = pd.DataFrame(npz['history'], index=dates, columns=npz['tickers'].tolist())
+        rebalance_dates = pd.DatetimeIndex(npz['rebalance_dates'].astype('datetime64[ns]'))
+        turnover = pd.Series(npz['turnover'], index=dates, name=spec.get('port_name', 'Port')) if 'turnover' in npz else None
+    return BacktestResult(history, rebalance_dates, spec, turnover)
+
+
+class ResultStore:
+    '''Content-addressed, on-disk store of backtest results.
+
+    Each result is one compressed .npz file holding the portfolio history, plus a small json sidecar with the spec.
+    Metrics aren't stored, since they also depend on the benchmark, which isn't part of the key. Files are written to a temp file and moved into place, so any number of processes can read
+    while another one writes. Once the store grows past max_bytes (or max_entries) the least recently used
+    results are deleted.
+    '''
+
+    def __init__(self, folder: str = RESULTS_FOLDER, max_bytes: int = MAX_STORE_BYTES,
+                 max_entries: int = MAX_STORE_ENTRIES) -> None:
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(folder, exist_ok=True)
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        return os.path.join(self.folder, f'{key}.npz'), os.path.join(self.folder, f'{key}.json')
+
+    def __contains__(self, key: str) -> bool:
+        return all(os.path.exists(path) for path in self._paths(key))
+
+    def save(self, key: str, backtest: bt.Backtester, spec: dict) -> None:
+        '''Store the outputs of a finished backtest under key (see backtest_key).'''
+
+        meta = {'key': key, 'spec': spec, 'created': time.time()}
+
+        data_path, meta_path = self._paths(key)
+        # Data first, so a sidecar never points at a missing result
+        utils.atomic_write(data_path, pack_result(backtest))
+        utils.atomic_write(meta_path, json.dumps(meta, default=str).encode())
+        self.evict()
+
+    def load(self, key: str) -> BacktestResult | None:
+        '''Load a stored result, or None if there isn't one.'''
+
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(data_path, 'rb') as f:
+                data = f.read()
+        except (FileNotFoundError, ValueError):
+            # Not there, or evicted mid read. Either way it's a miss.
+            return None
+
+        # Mark as recently used for the eviction policy
+        try:
+            os.utime(meta_path)
+        except FileNotFoundError:
+            pass
+
+        return unpack_result(data, meta['spec'])
+
+    def list_runs(self) -> pd.DataFrame:
+        '''One row per stored result with its spec, size and when it was created and last used.'''
+
+        rows = []
+        for file in os.listdir(self.folder):
+            if not file.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.folder, file)
+            data_path = meta_path[:-len('.json')] + '.npz'
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                size = os.path.getsize(data_path) + os.path.getsize(meta_path)
+                last_used = os.path.getmtime(meta_path)
+            except (FileNotFoundError, ValueError):
+                continue
+            rows.append({
+                'key': meta['key'],
+                'created': pd.to_datetime(meta['created'], unit='s'),
+                'last_used': pd.to_datetime(last_used, unit='s'),
+                'size_bytes': size,
+                **meta['spec'],
+            })
+
+        columns = ['key', 'created', 'last_used', 'size_bytes']
+        return pd.DataFrame(rows, columns=columns if not rows else None).sort_values('last_used', ascending=False)
+
+    def compare(self, keys: list[str]) -> pd.DataFrame:
+        '''Wealth indexes of several stored runs side by side, without re-running anything.'''
+
+        wealth = {}
+        for key in keys:
+            result = self.load(key)
+            if result is not None:
+                wealth[key] = result.wealth_index
+        return pd.DataFrame(wealth)
+
+    def evict(self) -> None:
+        '''Delete the least recently used results until the store is within its size and entry limits.'''
+
+        runs = self.list_runs().sort_values('last_used')
+        total_bytes, n_entries = runs['size_bytes'].sum(), len(runs)
+        for _, run in runs.iterrows():
+            if total_bytes <= self.max_bytes and n_entries <= self.max_entries:
+                break
+            for path in self._paths(run['key']):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= run['size_bytes']
+            n_entries -= 1
+
+
+if __name__ == '__main__':
+    import data_engine as dd
+
+    data = dd.DataEngine.load_saved_data('data/')
+    spec = dict(tickers=['AAPL', 'MSFT'], weights=[0.5, 0.5], start_date='2010-01-01', end_date='2020-01-01')
+    key = backtest_key(spec, data)
+
+    store = ResultStore(tempfile.mkdtemp(prefix='results_'))
+    backtest = bt.Backtester(data_blob=data, **spec)
+    backtest.run_backtest()
+    store.save(key, backtest, spec)
+
+    t0 = time.time()
+    cached = store.load(key)
+    print(f'Loaded in {(time.time() - t0) * 1000:.0f}ms, same result: {cached.wealth_index.equals(backtest.wealth_index)}')
+    print(store.list_runs())
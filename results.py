@@ -1,14 +1,25 @@
+from concurrent.futures import Executor, as_completed
+from dataclasses import dataclass
 import pandas as pd
 import streamlit as st
 import plotly.express as px
+import matplotlib.pyplot as plt
 import datetime as dt
 
 import data_engine as dd
 import backtester as bt
 import inputs
 import metrics
+import correlation
+import drawdowns
+import periods
+import regression
 import utils
 
+# Above this many securities the correlation matrix is drawn as a heatmap image instead of a styled table
+STYLED_CORR_LIMIT = 30
+LABELED_HEATMAP_LIMIT = 100
+
 
 # Utility Functions
 def format_as_percent(df: pd.DataFrame, columns: list) -> pd.DataFrame:
@@ -33,7 +44,38 @@ def plot_bar_chart(df: pd.Series, title: str, yaxis_title: str) -> None:
     st.plotly_chart(fig)
 
 
-def display_results(backtest:bt.Backtester,data:dd.DataEngine, cleaned_inputs:inputs.CleanInputs) -> None:
+def plot_corr_heatmap(corr: pd.DataFrame, title: str) -> None:
+    '''Render a correlation matrix as a static heatmap image. Much cheaper than a styled table once we have more
+    than a few dozen securities.'''
+    fig, ax = plt.subplots(figsize=(10, 8))
+    img = ax.imshow(corr.to_numpy(dtype=float), cmap='coolwarm', vmin=-1, vmax=1, interpolation='nearest')
+    fig.colorbar(img, ax=ax, fraction=0.046, pad=0.04)
+    ax.set_title(title)
+
+    # Only label the axes if there is room to read them
+    if len(corr) <= LABELED_HEATMAP_LIMIT:
+        ax.set_xticks(range(len(corr)), corr.columns, rotation=90, fontsize=6)
+        ax.set_yticks(range(len(corr)), corr.index, fontsize=6)
+    else:
+        ax.set_xticks([])
+        ax.set_yticks([])
+
+    st.pyplot(fig)
+    plt.close(fig)
+
+
+@dataclass
+class ResultsContext:
+    '''The inputs every results section is computed from.'''
+
+    backtest: bt.Backtester
+    all_rets_df: pd.DataFrame
+    bench_rets: pd.Series
+    factor_rets_df: pd.DataFrame
+    security_prices_df: pd.DataFrame
+
+
+def build_context(backtest:bt.Backtester,data:dd.DataEngine, cleaned_inputs:inputs.CleanInputs) -> ResultsContext:
 
     start_dt = pd.to_datetime(cleaned_inputs.start_date)
 
@@ -44,53 +86,93 @@ def display_results(backtest:bt.Backtester,data:dd.DataEngine, cleaned_inputs:in
     all_rets_df = pd.concat([backtest.port_returns, security_rets_df], axis=1)
     security_prices_df = data.price_df[data.price_df.index > start_dt].loc[:cleaned_inputs.end_date]
     security_prices_df = security_prices_df[cleaned_inputs.tickers]
+    factor_rets_df = rets_filered_df[list(dict.fromkeys([cleaned_inputs.bench_ticker] + cleaned_inputs.factor_tickers))]
 
-    bench_rets = rets_filered_df[cleaned_inputs.bench_ticker]
+    return ResultsContext(backtest, all_rets_df, bench_rets, factor_rets_df, security_prices_df)
 
-    st.markdown("### Cumulative Returns")
 
-    cum_rets_df = (1 + all_rets_df).cumprod() - 1
+# ----------------------------
+# Results sections. Each one is split into a compute step (no streamlit calls, so it can run in a background
+# thread) and a render step that draws whatever the compute step returned.
+# ----------------------------
 
-    plot_line_chart(cum_rets_df, "Cumulative Returns", "Cumulative Returns")
+def compute_cumulative_returns(ctx: ResultsContext) -> dict:
+    cum_rets_df = (1 + ctx.all_rets_df).cumprod() - 1
+    return {
+        'cum_rets_df': cum_rets_df,
+        'total_rets': cum_rets_df.iloc[-1].sort_values(ascending=False),
+        'period_rets': {name: periods.period_returns_df(ctx.all_rets_df, freq)
+                        for name, freq in [('Annual', 'Y'), ('Quarterly', 'Q'), ('Monthly', 'M')]},
+    }
+
+
+def render_cumulative_returns(out: dict) -> None:
+    st.markdown("### Cumulative Returns")
+    plot_line_chart(out['cum_rets_df'], "Cumulative Returns", "Cumulative Returns")
     
     # Bar plot of total return
-    total_rets = cum_rets_df.iloc[-1].sort_values(ascending=False)
-    plot_bar_chart(total_rets, "Total Returns", "Total Return")
+    plot_bar_chart(out['total_rets'], "Total Returns", "Total Return")
 
-    # Add on yearly returns, if we have enough data
-    annual_rets = all_rets_df.resample('YE').apply(lambda x: (1 + x).prod() - 1)
-    if len(annual_rets) > 1:
-        st.markdown("#### Annual Returns")        
-        annual_rets.index = annual_rets.index.year
-        annual_rets = annual_rets.T
-        # Format these returns as a heatmap each year
-        annual_rets = annual_rets.style.format("{:.2%}").background_gradient(cmap='RdYlGn', axis=1)
+    # Add on calendar period returns, if we have enough data
+    if len(out['period_rets']['Annual']) > 1:
+        st.markdown("#### Calendar Period Returns")
+        tabs = st.tabs(list(out['period_rets']))
+        for tab, period_rets in zip(tabs, out['period_rets'].values()):
+            with tab:
+                # Format these returns as a heatmap each period
+                st.write(period_rets.T.style.format("{:.2%}").background_gradient(cmap='RdYlGn', axis=1))
 
 
-        st.write(annual_rets)
+ROLLING_WINDOW = 252
 
-    # Volatility
+def compute_volatility(ctx: ResultsContext) -> dict:
     # Display the vol in a bar chart in the same order as the total rets
+    total_rets = ((1 + ctx.all_rets_df).prod() - 1).sort_values(ascending=False)
+    total_vol = ctx.all_rets_df.std() * 252 ** 0.5
+    out = {'total_vol': total_vol[total_rets.index], 'rolling_vols': None}
+
+    # If you have enough data, plot the rolling vol
+    if len(ctx.all_rets_df) > ROLLING_WINDOW:
+        rolling_vols = ctx.all_rets_df.rolling(window=ROLLING_WINDOW).std() * 252 ** 0.5
+        out['rolling_vols'] = rolling_vols.dropna()
+    return out
+
+
+def render_volatility(out: dict) -> None:
     st.markdown("### Volatility")    
-    total_vol = all_rets_df.std() * 252 ** 0.5
+    plot_bar_chart(out['total_vol'], "Total Period Annualized Volatility", "Volatility")
+    if out['rolling_vols'] is not None:
+        plot_line_chart(out['rolling_vols'], "Rolling 1-Year Volatility", "Volatility")
 
-    total_vol = total_vol[total_rets.index]
-    plot_bar_chart(total_vol, "Total Period Annualized Volatility", "Volatility")
 
-    # If you have enough data, plot the rolling vol
-    ROLLING_WINDOW = 252
-    if len(all_rets_df) > ROLLING_WINDOW:
-    
-        rolling_vols = all_rets_df.rolling(window=252).std() * 252 ** 0.5
-        rolling_vols = rolling_vols.dropna()
-        plot_line_chart(rolling_vols, "Rolling 1-Year Volatility", "Volatility")
+def compute_drawdowns(ctx: ResultsContext) -> dict:
+    # The returns start the day after the start date, which is where the starting wealth sits
+    dd_results = drawdowns.analyze_drawdowns(ctx.all_rets_df, start_date=ctx.backtest.start_date)
 
-    #---------------------------
-    # Metrics
-    #---------------------------
+    stats_df = format_as_percent(dd_results.stats.copy(), ['Max Drawdown', 'CAGR', 'Ulcer Index', 'Pain Index', 'Time Underwater'])
+    stats_df['Calmar'] = stats_df['Calmar'].map('{:.2f}'.format)
+
+    # The worst drawdowns of just the portfolio
+    port_name = ctx.all_rets_df.columns[0]
+    episodes_df = dd_results.episodes[dd_results.episodes['Column'] == port_name].drop(columns='Column')
+    episodes_df = format_as_percent(episodes_df.reset_index(drop=True), ['Depth'])
+    for col in ['Peak', 'Trough', 'Recovery']:
+        episodes_df[col] = episodes_df[col].dt.date
+    return {'underwater_df': dd_results.underwater_df(), 'stats_df': stats_df, 'episodes_df': episodes_df,
+            'port_name': port_name}
+
+
+def render_drawdowns(out: dict) -> None:
+    st.markdown("### Drawdowns")
+    plot_line_chart(out['underwater_df'], "Drawdown From Peak", "Drawdown")
+    st.write(out['stats_df'])
+    st.markdown(f"#### Worst {out['port_name']} Drawdowns")
+    st.write(out['episodes_df'])
+
+
+def compute_metrics(ctx: ResultsContext) -> pd.DataFrame:
+    metrics_df = ctx.all_rets_df.apply(metrics.calculate_metrics, args=(ctx.bench_rets,),axis=0)
 
-    st.markdown("### Performance Metrics")    
-    metrics_df = all_rets_df.apply(metrics.calculate_metrics, args=(bench_rets,),axis=0)
     # We want to apply lots of fun formatting to the metrics
     metrics_pretty_df = metrics_df.T.copy()
     COLS_TO_PRETTIFY = ['Total Return', 'CAGR', 'Volatility', 'Max Drawdown', 'Alpha', 'Downside Deviation']
@@ -98,38 +180,68 @@ def display_results(backtest:bt.Backtester,data:dd.DataEngine, cleaned_inputs:in
     # Format the following columns to onlu 2 decimal places
     DECIMAL_COLS = ['Beta', 'Sharpe', 'Up Capture', 'Down Capture']
     metrics_pretty_df[DECIMAL_COLS] = metrics_pretty_df[DECIMAL_COLS].map('{:.2f}'.format)
+    return metrics_pretty_df
 
+
+def render_metrics(metrics_pretty_df: pd.DataFrame) -> None:
+    st.markdown("### Performance Metrics")    
     st.write(metrics_pretty_df)
 
-    # ----------------------------
-    # Correlation Matrix
-    # ----------------------------
+
+def compute_factor_regression(ctx: ResultsContext) -> dict:
+    fit = regression.regress(ctx.all_rets_df, ctx.factor_rets_df)
+    summary_df = fit.summary()
+
+    PERCENT_COLS = ['Alpha', 'Residual Vol', 'R-Squared'] + [c for c in summary_df.columns if c.startswith('Tracking Error')]
+    summary_df = format_as_percent(summary_df, PERCENT_COLS)
+    DECIMAL_COLS = [c for c in summary_df.columns if c not in PERCENT_COLS and c != 'Observations']
+    summary_df[DECIMAL_COLS] = summary_df[DECIMAL_COLS].map('{:.2f}'.format)
+
+    # Rolling betas of just the portfolio, if there is enough data
+    rolling_betas = None
+    if len(ctx.all_rets_df) > ROLLING_WINDOW:
+        rolling = regression.rolling_regress(ctx.all_rets_df.iloc[:, :1], ctx.factor_rets_df, window=ROLLING_WINDOW)
+        rolling_betas = pd.DataFrame({f: rolling[f'beta ({f})'].iloc[:, 0] for f in ctx.factor_rets_df.columns}).dropna(how='all')
+    return {'summary_df': summary_df, 'rolling_betas': rolling_betas}
+
+
+def render_factor_regression(out: dict) -> None:
+    st.markdown("### Factor Regression")
+    st.write(out['summary_df'])
+    if out['rolling_betas'] is not None and not out['rolling_betas'].empty:
+        fig = px.line(out['rolling_betas'], title="Rolling 1-Year Portfolio Betas")
+        fig.update_yaxes(title_text="Beta")
+        fig.update_xaxes(title_text="Date")
+        st.plotly_chart(fig)
+
+
+def compute_correlation(ctx: ResultsContext) -> pd.DataFrame:
+    return correlation.clustered_corr(ctx.all_rets_df)
+
+
+def render_correlation(corr: pd.DataFrame) -> None:
     st.markdown("### Correlation Matrix")
-    corr = all_rets_df.corr()
-    corr_pretty_df = corr.copy()
-    # # corr_pretty_df = corr_pretty_df.applymap('{:.2f}'.format)
-    corr_pretty_df = corr.style.format("{:.2f}").background_gradient(cmap='coolwarm', vmin=-1, vmax=1)
-    st.write(corr_pretty_df)
+    if len(corr) <= STYLED_CORR_LIMIT:
+        corr_pretty_df = corr.style.format("{:.2f}").background_gradient(cmap='coolwarm', vmin=-1, vmax=1)
+        st.write(corr_pretty_df)
+    else:
+        plot_corr_heatmap(corr, "Correlation Matrix (Clustered)")
 
 
-    # Portfolio Weights Over Time
-    st.markdown("### Portfolio Weights Over Time")
-    plot_line_chart(backtest.weights_df, "Portfolio Weights Over Time", "Weight")
+def compute_weights(ctx: ResultsContext) -> pd.DataFrame:
+    return ctx.backtest.weights_df
 
 
-    # # Returns
-    # st.markdown("### Individual Returns")
-    # # Add a tab for each of the securities and show a plot of it's indivdiual cumualtive return
-    # ret_tabs = st.tabs(cum_rets_df.columns.to_list())
-    # for ticker, tab in zip(cum_rets_df.columns, ret_tabs):
-    #     with tab:
-    #         total_ret = cum_rets_df[ticker].iloc[-1]
-    #         st.write(f"Total Return: {total_ret:.2%}")
-    #         plot_line_chart(cum_rets_df[ticker], f"{ticker} Cumulative Return", "Cumulative Return")
+def render_weights(weights_df: pd.DataFrame) -> None:
+    st.markdown("### Portfolio Weights Over Time")
+    plot_line_chart(weights_df, "Portfolio Weights Over Time", "Weight")
 
-    #         # Add on another bar chart that shows the return on different time periods.
 
+def compute_prices(ctx: ResultsContext) -> pd.DataFrame:
+    return ctx.security_prices_df
 
+
+def render_prices(security_prices_df: pd.DataFrame) -> None:
     st.markdown("### Individual Prices")
     st.write('_These prices are not adjusted for splits or dividends_')
     price_tabs = st.tabs(security_prices_df.columns.to_list())
@@ -142,35 +254,78 @@ def display_results(backtest:bt.Backtester,data:dd.DataEngine, cleaned_inputs:in
             st.plotly_chart(fig)
 
 
-    
+def compute_raw_data(ctx: ResultsContext) -> dict:
+    dates = pd.Series(ctx.backtest.rebalance_dates.date, name='Rebalance Dates')
 
-    # # ----------------------------
-    # # Display Raw Data
-    # # ----------------------------
+    # Work on copies, the other sections may be reading these at the same time
+    rets_df = utils.convert_dt_index(ctx.all_rets_df.copy())
+    # Format the returns as percentages and color code them. Positive returns are green, negative are red.
+    styled_df = rets_df.style.format("{:.2%}").map(utils.color_returns)
 
-    st.markdown("## Raw Data Reference")
+    weights_df = utils.convert_dt_index(ctx.backtest.weights_df.copy())
+    weights_df = weights_df.map('{:.2%}'.format)
+    return {'dates': dates, 'styled_rets': styled_df, 'weights_df': weights_df}
 
-    st.markdown("### Rebalance Dates")
-    dates = backtest.rebalance_dates
-    dates.name = 'Rebalance Dates'
-    dates = pd.Series(dates.date, name='Rebalance Dates')
-    st.write(dates)
 
+def render_raw_data(out: dict) -> None:
+    st.markdown("## Raw Data Reference")
 
+    st.markdown("### Rebalance Dates")
+    st.write(out['dates'])
 
     st.markdown("### Raw Returns")
-    rets_df = utils.convert_dt_index(all_rets_df)
-    # Format the returns as percentages and color code them. Positive returns are green, negative are red.
-    styled_df = rets_df.style.format("{:.2%}").map(utils.color_returns)
-    st.write(styled_df)
+    st.write(out['styled_rets'])
 
     # st.markdown("### Portfolio History")
     # st.write(utils.convert_dt_index(backtest.portfolio_history_df))
 
     st.markdown("### Raw Portfolio Weights")
-    weights_df = utils.convert_dt_index(backtest.weights_df)
-    weights_df = weights_df.map('{:.2%}'.format)
-    st.write(weights_df)
+    st.write(out['weights_df'])
+
+
+# In page order
+SECTIONS = [
+    (compute_cumulative_returns, render_cumulative_returns),
+    (compute_volatility, render_volatility),
+    (compute_drawdowns, render_drawdowns),
+    (compute_metrics, render_metrics),
+    (compute_factor_regression, render_factor_regression),
+    (compute_correlation, render_correlation),
+    (compute_weights, render_weights),
+    (compute_prices, render_prices),
+    (compute_raw_data, render_raw_data),
+]
+
+
+def display_results(backtest:bt.Backtester,data:dd.DataEngine, cleaned_inputs:inputs.CleanInputs,
+                    executor:Executor=None, progress=None) -> None:
+    '''Draw every results section. With an executor, all the sections are computed in the background at once and
+    each one is drawn (in its place on the page) as soon as its data is ready. progress, if given, is called as
+    progress(sections_ready, total_sections).'''
+
+    ctx = build_context(backtest, data, cleaned_inputs)
+
+    if executor is None:
+        for n, (compute, render) in enumerate(SECTIONS, start=1):
+            render(compute(ctx))
+            if progress is not None:
+                progress(n, len(SECTIONS))
+        return
+
+    # Reserve a spot for each section up front so they land in the right order whenever they finish
+    containers = [st.container() for _ in SECTIONS]
+    futures = {executor.submit(compute, ctx): i for i, (compute, _) in enumerate(SECTIONS)}
+    try:
+        for n, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            with containers[i]:
+                SECTIONS[i][1](future.result())
+            if progress is not None:
+                progress(n, len(SECTIONS))
+    finally:
+        # If the page is rerun part way through there is no point finishing the rest
+        for future in futures:
+            future.cancel()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,310 @@
+import argparse
+import io
+import json
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+
+import backtester as bt
+import data_engine as dd
+import result_store
+import universes
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PENDING = 32  # Backtests queued or running before new ones are turned away
+LATENCY_WINDOW = 1000  # Number of recent requests the latency stats are computed over
+SPEC_FIELDS = ['tickers', 'weights', 'start_date', 'end_date', 'rebal_freq']
+
+
+class ServiceBusy(Exception):
+    '''Raised when the service already has as many backtests pending as it is willing to take.'''
+
+
+class BacktestService:
+    '''Runs backtests for many users off one shared, read-only copy of the data.
+
+    Backtests go to a bounded worker pool. Identical specs that are already queued or running share a single run,
+    finished runs are served from the result store, and once max_pending backtests are in flight new ones are
+    rejected (rather than queueing forever) so callers can back off. Given a universe registry, backtests on a
+    known universe run off its precomputed matrices instead of the full data.
+    '''
+
+    def __init__(self, data: dd.DataEngine, workers: int = DEFAULT_WORKERS, max_pending: int = DEFAULT_MAX_PENDING,
+                 store: result_store.ResultStore = None, universe_registry: universes.UniverseRegistry = None) -> None:
+        self.data = data
+        self.universe_registry = universe_registry
+        self._universe_data: dict[str, dd.DataEngine] = {}
+        if universe_registry is not None:
+            universe_registry.build(data)
+        # The data never changes while the service is up, so the version only needs working out once
+        self.data_version = data.data_version
+        self.store = store
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backtest')
+
+        self._lock = threading.RLock()
+        self._in_flight: dict[str, Future] = {}
+        self._latencies = {'total': deque(maxlen=LATENCY_WINDOW), 'queue_wait': deque(maxlen=LATENCY_WINDOW),
+                           'run': deque(maxlen=LATENCY_WINDOW)}
+        self.counts = {'requests': 0, 'store_hits': 0, 'coalesced': 0, 'rejected': 0, 'errors': 0, 'runs': 0}
+
+    def validate_spec(self, spec: dict) -> dict:
+        '''Check a spec can be run on the shared data, and normalize it so equal specs hash the same.'''
+
+        missing_fields = [field for field in SPEC_FIELDS if field not in spec]
+        if missing_fields:
+            raise ValueError(f'Spec is missing fields: {missing_fields}')
+        spec = {field: spec[field] for field in SPEC_FIELDS}
+        spec['weights'] = [float(w) for w in spec['weights']]
+        spec['start_date'] = str(pd.Timestamp(spec['start_date']).date())
+        spec['end_date'] = str(pd.Timestamp(spec['end_date']).date())
+
+        missing_tickers = [t for t in spec['tickers'] if t not in self.data.tickers]
+        if missing_tickers:
+            raise ValueError(f'Missing data for some tickers. Missing tickers: {missing_tickers}')
+        missing_returns = self.data.quality.missing_tickers(spec['tickers'], spec['start_date'], spec['end_date'])
+        if missing_returns:
+            raise ValueError(f'Missing returns for some tickers during the backtest period. Problem tickers: {missing_returns}')
+        return spec
+
+    def submit(self, spec: dict) -> tuple[str, Future]:
+        '''Queue a backtest. The future resolves to the packed result (see result_store.pack_result).'''
+
+        spec = self.validate_spec(spec)
+        key = result_store.backtest_key(spec, self.data)
+
+        with self._lock:
+            self.counts['requests'] += 1
+            if key in self._in_flight:
+                self.counts['coalesced'] += 1
+                return key, self._in_flight[key]
+
+        if self.store is not None:
+            stored = self.store.load(key)
+            if stored is not None:
+                with self._lock:
+                    self.counts['store_hits'] += 1
+                future = Future()
+                future.set_result(result_store.pack_result(stored))
+                return key, future
+
+        with self._lock:
+            # Someone may have submitted the same spec while we were checking the store
+            if key in self._in_flight:
+                self.counts['coalesced'] += 1
+                return key, self._in_flight[key]
+            if len(self._in_flight) >= self.max_pending:
+                self.counts['rejected'] += 1
+                raise ServiceBusy(f'{len(self._in_flight)} backtests already pending. Try again shortly.')
+
+            future = self.executor.submit(self._run, key, spec, time.perf_counter())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._finish(key))
+        return key, future
+
+    def _data_for(self, spec: dict) -> dd.DataEngine:
+        '''The smallest universe that covers the backtest, or the full data if none does.'''
+
+        if self.universe_registry is None:
+            return self.data
+        universe = self.universe_registry.find(spec['tickers'], spec['start_date'], spec['end_date'])
+        if universe is None:
+            return self.data
+        with self._lock:
+            # Keyed by build folder, so a rebuilt universe gets a fresh engine
+            if universe.folder not in self._universe_data:
+                self._universe_data[universe.folder] = universe.as_data_engine()
+            return self._universe_data[universe.folder]
+
+    def _finish(self, key: str) -> None:
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def _run(self, key: str, spec: dict, submitted: float) -> bytes:
+        started = time.perf_counter()
+        try:
+            data = self._data_for(spec)
+            # The kernel engine reads a universe's matrices directly, rather than looking up every day by label
+            engine = 'python' if data is self.data else 'kernel'
+            backtest = bt.Backtester(data_blob=data, engine=engine, **spec)
+            backtest.run_backtest()
+            if self.store is not None:
+                self.store.save(key, backtest, spec)
+        except Exception:
+            with self._lock:
+                self.counts['errors'] += 1
+            raise
+
+        with self._lock:
+            self.counts['runs'] += 1
+            self._latencies['queue_wait'].append(started - submitted)
+            self._latencies['run'].append(time.perf_counter() - started)
+        return result_store.pack_result(backtest)
+
+    def record_latency(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies['total'].append(seconds)
+
+    def stats(self) -> dict:
+        '''Request counts plus latency percentiles (in ms) over the most recent requests.'''
+
+        with self._lock:
+            stats = {'pending': len(self._in_flight), 'data_version': self.data_version, **self.counts}
+            for name, latencies in self._latencies.items():
+                values = np.array(latencies) * 1000
+                stats[f'{name}_ms'] = {
+                    'count': len(values),
+                    'mean': float(values.mean()) if len(values) else None,
+                    **{f'p{p}': float(np.percentile(values, p)) if len(values) else None for p in (50, 95, 99)},
+                }
+        return stats
+
+    def get_data(self, tickers: list[str], start, end) -> dict:
+        '''Returns and prices for the tickers within [start, end], in a json friendly form.'''
+
+        missing_tickers = [t for t in tickers if t not in self.data.tickers]
+        if missing_tickers:
+            raise ValueError(f'Missing data for some tickers. Missing tickers: {missing_tickers}')
+        rets_df = self.data.rets_df.loc[start:end, tickers]
+        price_df = self.data.price_df.loc[start:end, tickers]
+        return {'rets': rets_df.to_json(orient='split', date_format='iso'),
+                'prices': price_df.to_json(orient='split', date_format='iso')}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    '''HTTP front end for a BacktestService (attached to the server as server.service).'''
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json', headers: dict = {}) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: dict, headers: dict = {}) -> None:
+        self._send(status, json.dumps(payload).encode(), headers=headers)
+
+    def do_GET(self) -> None:
+        service: BacktestService = self.server.service
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/health':
+            self._send_json(200, {'status': 'ok', 'data_version': service.data_version})
+        elif url.path == '/stats':
+            self._send_json(200, service.stats())
+        elif url.path == '/data':
+            try:
+                tickers = query['tickers'][0].split(',')
+                payload = service.get_data(tickers, query.get('start', [None])[0], query.get('end', [None])[0])
+            except (KeyError, ValueError) as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            self._send_json(200, payload)
+        else:
+            self._send_json(404, {'error': f'Unknown path {url.path}'})
+
+    def do_POST(self) -> None:
+        service: BacktestService = self.server.service
+        if urllib.parse.urlparse(self.path).path != '/backtest':
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+
+        started = time.perf_counter()
+        try:
+            spec = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            key, future = service.submit(spec)
+            packed = future.result()
+        except ServiceBusy as e:
+            self._send_json(503, {'error': str(e)}, headers={'Retry-After': '1'})
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {'error': repr(e)})
+            return
+
+        service.record_latency(time.perf_counter() - started)
+        self._send(200, packed, content_type='application/octet-stream', headers={'X-Result-Key': key})
+
+    def log_message(self, format, *args) -> None:
+        # Keep the console quiet, the latency stats are more useful than a line per request
+        pass
+
+
+def make_server(service: BacktestService, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    return server
+
+
+class BacktestClient:
+    '''Talks to a running backtest service. Returns the same objects the local code path would.'''
+
+    def __init__(self, url: str, timeout: float = 300) -> None:
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path: str, body: bytes = None) -> tuple[bytes, dict]:
+        request = urllib.request.Request(f'{self.url}{path}', data=body,
+                                         headers={'Content-Type': 'application/json'} if body else {})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.read(), dict(response.headers)
+        except urllib.error.HTTPError as e:
+            message = json.loads(e.read() or b'{}').get('error', str(e))
+            if e.code == 503:
+                raise ServiceBusy(message) from e
+            if e.code == 400:
+                raise ValueError(message) from e
+            raise
+
+    def run_backtest(self, spec: dict) -> result_store.BacktestResult:
+        packed, headers = self._request('/backtest', json.dumps(spec, default=str).encode())
+        return result_store.unpack_result(packed, spec)
+
+    def get_data(self, tickers: list[str], start, end) -> dd.DataEngine:
+        query = urllib.parse.urlencode({'tickers': ','.join(tickers), 'start': str(start), 'end': str(end)})
+        payload = json.loads(self._request(f'/data?{query}')[0])
+        data = dd.DataEngine()
+        data.rets_df = pd.read_json(io.StringIO(payload['rets']), orient='split')
+        data.price_df = pd.read_json(io.StringIO(payload['prices']), orient='split')
+        return data
+
+    def stats(self) -> dict:
+        return json.loads(self._request('/stats')[0])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the shared backtest service.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--max-pending', type=int, default=DEFAULT_MAX_PENDING)
+    parser.add_argument('--data-folder', default=dd.DATA_FOLDER)
+    parser.add_argument('--results-folder', default=result_store.RESULTS_FOLDER)
+    args = parser.parse_args()
+
+    service = BacktestService(
+        data=dd.DataEngine.load_saved_data(args.data_folder),
+        workers=args.workers,
+        max_pending=args.max_pending,
+        store=result_store.ResultStore(args.results_folder),
+        universe_registry=universes.UniverseRegistry(args.data_folder),
+    )
+    server = make_server(service, args.host, args.port)
+    print(f'Serving backtests on http://{args.host}:{args.port} (data version {service.data_version})')
+    server.serve_forever()
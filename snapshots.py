@@ -0,0 +1,200 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+import pandas as pd
+
+import utils
+from data_quality import DataQualityIndex
+
+
+OBJECTS_FOLDER = 'objects'
+VERSIONS_FOLDER = 'versions'
+LATEST_FILE = 'LATEST'
+FRESHNESS_FILE = 'freshness.json'
+LOCK_FILE = 'commit.lock'
+QUALITY_FOLDER = 'quality'
+QUALITY_TICKERS_FILE = 'tickers.json'
+MAX_VERSIONS_KEPT = 50
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def tickers_version(ticker_hashes: dict[str, str]) -> str:
+    '''Version id for a set of tickers, derived only from their content hashes. The same data always gives the same
+    version, no matter when (or how many times) it was downloaded.'''
+    payload = json.dumps(sorted(ticker_hashes.items())).encode()
+    return content_hash(payload)[:16]
+
+
+class SnapshotStore:
+    '''Immutable, versioned snapshots of the raw per-ticker data.
+
+    Every ticker's data is saved once under its content hash (objects/<hash>.csv). A version is a manifest
+    (versions/<version>.json) mapping each ticker to the hash of its data, and LATEST points at the newest one.
+    Objects and manifests are never modified, so any old version can be reloaded exactly. When each ticker was
+    last checked against the source is tracked separately in freshness.json, so re-downloading identical data
+    doesn't create a new version. Anything that changes LATEST or deletes files holds LOCK_FILE, so commits from
+    any number of threads or processes never lose each other's tickers. The data quality index built from a set of tickers is kept too (under
+    quality/<version of those tickers>), so it only has to be built once per distinct set of data.
+    '''
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        os.makedirs(os.path.join(folder, OBJECTS_FOLDER), exist_ok=True)
+        os.makedirs(os.path.join(folder, VERSIONS_FOLDER), exist_ok=True)
+
+    def _object_path(self, obj_hash: str) -> str:
+        return os.path.join(self.folder, OBJECTS_FOLDER, f'{obj_hash}.csv')
+
+    def _manifest_path(self, version: str) -> str:
+        return os.path.join(self.folder, VERSIONS_FOLDER, f'{version}.json')
+
+    @property
+    def latest_version(self) -> str | None:
+        try:
+            with open(os.path.join(self.folder, LATEST_FILE)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def manifest(self, version: str = None) -> dict:
+        '''The manifest for a version (latest by default). Empty if nothing has been saved yet.'''
+        version = version or self.latest_version
+        if version is None:
+            return {'version': None, 'parent': None, 'created': None, 'tickers': {}}
+        with open(self._manifest_path(version)) as f:
+            return json.load(f)
+
+    def freshness(self) -> dict[str, float]:
+        '''When each ticker was last fetched from the source (as a unix timestamp).'''
+        try:
+            with open(os.path.join(self.folder, FRESHNESS_FILE)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _lock(self):
+        return utils.file_lock(os.path.join(self.folder, LOCK_FILE))
+
+    def commit(self, ticker_dfs: dict[str, pd.DataFrame]) -> str:
+        '''Save freshly downloaded data. Only tickers whose content actually changed get new objects, and a new
+        version is only created if at least one ticker changed. Returns the (possibly unchanged) latest version.'''
+
+        payloads = {ticker: df.to_csv().encode() for ticker, df in ticker_dfs.items()}
+        # The parent has to be read under the lock, otherwise two commits both build on the same parent and the
+        # second one to move LATEST drops the first one's tickers
+        with self._lock():
+            parent = self.manifest()
+            ticker_hashes = dict(parent['tickers'])
+
+            for ticker, data in payloads.items():
+                obj_hash = content_hash(data)
+                if not os.path.exists(self._object_path(obj_hash)):
+                    utils.atomic_write(self._object_path(obj_hash), data)
+                ticker_hashes[ticker] = obj_hash
+
+            version = parent['version']
+            if ticker_hashes != parent['tickers']:
+                version = tickers_version(ticker_hashes)
+                manifest = {'version': version, 'parent': parent['version'], 'created': time.time(), 'tickers': ticker_hashes}
+                if not os.path.exists(self._manifest_path(version)):
+                    utils.atomic_write(self._manifest_path(version), json.dumps(manifest).encode())
+                utils.atomic_write(os.path.join(self.folder, LATEST_FILE), version.encode())
+
+            # Only once LATEST has the tickers, so nothing counts as fresh before it can actually be loaded
+            fetched = self.freshness()
+            fetched.update({ticker: time.time() for ticker in ticker_dfs})
+            utils.atomic_write(os.path.join(self.folder, FRESHNESS_FILE), json.dumps(fetched).encode())
+
+            if version != parent['version']:
+                self._prune()
+        return version
+
+    def load(self, tickers: list[str], version: str = None) -> tuple[dict[str, pd.DataFrame], dict[str, str]]:
+        '''Load the data for tickers as of a version (latest by default). Returns the per-ticker frames and their
+        content hashes. Tickers that aren't in the version are left out.'''
+
+        manifest = self.manifest(version)
+        dfs, hashes = {}, {}
+        for ticker in tickers:
+            obj_hash = manifest['tickers'].get(ticker)
+            if obj_hash is None:
+                continue
+            with open(self._object_path(obj_hash), 'rb') as f:
+                dfs[ticker] = pd.read_csv(io.BytesIO(f.read()), index_col=0, parse_dates=True)
+            hashes[ticker] = obj_hash
+        return dfs, hashes
+
+    def _quality_folder(self, ticker_hashes: dict[str, str]) -> str:
+        return os.path.join(self.folder, QUALITY_FOLDER, tickers_version(ticker_hashes))
+
+    def load_quality(self, ticker_hashes: dict[str, str]) -> DataQualityIndex | None:
+        '''The saved quality index for exactly these tickers' data, or None if it hasn't been built yet.'''
+        try:
+            return DataQualityIndex.load(self._quality_folder(ticker_hashes))
+        except ValueError:
+            return None
+
+    def save_quality(self, ticker_hashes: dict[str, str], quality: DataQualityIndex) -> None:
+        folder = self._quality_folder(ticker_hashes)
+        with self._lock():
+            os.makedirs(folder, exist_ok=True)
+            # The hashes go first, so prune can always tell which objects an index was built from
+            utils.atomic_write(os.path.join(folder, QUALITY_TICKERS_FILE), json.dumps(ticker_hashes).encode())
+            quality.save(folder)
+
+    def prune(self, keep_versions: int = MAX_VERSIONS_KEPT) -> None:
+        '''Delete all but the newest keep_versions manifests, and any objects no longer referenced by one.'''
+        with self._lock():
+            self._prune(keep_versions)
+
+    def _prune(self, keep_versions: int = MAX_VERSIONS_KEPT) -> None:
+
+        versions_dir = os.path.join(self.folder, VERSIONS_FOLDER)
+        manifests = []
+        for file in os.listdir(versions_dir):
+            if file.endswith('.json'):
+                with open(os.path.join(versions_dir, file)) as f:
+                    manifests.append(json.load(f))
+        manifests.sort(key=lambda m: m['created'], reverse=True)
+
+        latest = self.latest_version
+        keep = [m for i, m in enumerate(manifests) if i < keep_versions or m['version'] == latest]
+        for m in manifests:
+            if m not in keep:
+                os.remove(self._manifest_path(m['version']))
+
+        referenced = {obj_hash for m in keep for obj_hash in m['tickers'].values()}
+        objects_dir = os.path.join(self.folder, OBJECTS_FOLDER)
+        for file in os.listdir(objects_dir):
+            if file.endswith('.csv') and file[:-len('.csv')] not in referenced:
+                os.remove(os.path.join(objects_dir, file))
+
+        # Quality indexes built from data that is no longer in any kept version
+        quality_dir = os.path.join(self.folder, QUALITY_FOLDER)
+        for key in os.listdir(quality_dir) if os.path.isdir(quality_dir) else []:
+            try:
+                with open(os.path.join(quality_dir, key, QUALITY_TICKERS_FILE)) as f:
+                    hashes = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if not set(hashes.values()) <= referenced:
+                shutil.rmtree(os.path.join(quality_dir, key), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    store = SnapshotStore(tempfile.mkdtemp(prefix='snapshots_'))
+    prices = pd.read_csv('data/price_df.csv', index_col=0, parse_dates=True)
+
+    v1 = store.commit({'SPY': prices[['SPY']].dropna(), 'QQQ': prices[['QQQ']].dropna()})
+    v2 = store.commit({'SPY': prices[['SPY']].dropna()})
+    v3 = store.commit({'SPY': prices[['SPY']].dropna().iloc[:-1]})
+    print(f'v1={v1} v2={v2} (unchanged: {v1 == v2}) v3={v3}')
+    print(store.manifest(v3))
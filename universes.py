@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+import constants as C
+import data_engine as dd
+import utils
+from data_quality import DataQualityIndex
+from snapshots import content_hash, tickers_version
+
+
+UNIVERSES_FILE = 'universes.json'
+UNIVERSES_FOLDER = 'universes'
+CURRENT_FILE = 'CURRENT'  # Names the build (sub folder) of a universe that is currently in use
+TMP_PREFIX = '.tmp_'  # Builds are written to a folder starting with this and renamed once complete
+MAX_BUILDS_KEPT = 2  # The current build plus the one before it, which running readers may still have mapped
+# universes.json is seeded with these the first time a registry is opened. After that the file is the source of
+# truth, so universes can be added or changed without touching the code.
+DEFAULT_UNIVERSES = {
+    'single_stocks': C.SINGLE_STOCK_TICKERS,
+    'sectors': C.SECTOR_TICKERS,
+    'fixed_income': C.FI_TICKERS,
+    'market': C.MARKET_TICKERS,
+}
+
+
+class Universe:
+    '''A named group of tickers with its returns and prices stored as aligned, contiguous (date, ticker) matrices.
+
+    common_start / common_end bound the dates on which every ticker has a return, and gaps lists any dates in
+    between where one doesn't, so a date window can be checked without scanning the returns.
+    '''
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        self.name = meta['name']
+        self.tickers = meta['tickers']
+        self.version = meta['version']
+        self.ticker_hashes = meta['ticker_hashes']
+        self.common_start = pd.Timestamp(meta['common_start']) if meta['common_start'] else None
+        self.common_end = pd.Timestamp(meta['common_end']) if meta['common_end'] else None
+        self.dates = np.load(os.path.join(folder, 'dates.npy'))
+        self.gaps = np.load(os.path.join(folder, 'gaps.npy'))
+        self.rets = np.load(os.path.join(folder, 'rets.npy'), mmap_mode='r')
+        self.prices = np.load(os.path.join(folder, 'prices.npy'), mmap_mode='r')
+
+    def __repr__(self) -> str:
+        if self.common_start is None:
+            return f'Universe {self.name}: {len(self.tickers)} tickers, no common dates'
+        return f'Universe {self.name}: {len(self.tickers)} tickers, {self.common_start.date()} - {self.common_end.date()}'
+
+    def covers(self, tickers: list[str], start, end) -> bool:
+        '''True if every ticker is in the universe and has a return on every date in [start, end].'''
+
+        if self.common_start is None or not set(tickers) <= set(self.tickers):
+            return False
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        if start < self.common_start or end > self.common_end:
+            return False
+        lo = np.searchsorted(self.gaps, np.datetime64(start, 'ns'), side='left')
+        hi = np.searchsorted(self.gaps, np.datetime64(end, 'ns'), side='right')
+        return lo == hi
+
+    def window(self, start=None, end=None) -> tuple[np.ndarray, np.ndarray]:
+        '''Dates and returns within [start, end]. Both are views into the stored matrices, nothing is copied.'''
+
+        lo = 0 if start is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+        hi = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+        return self.dates[lo:hi], self.rets[lo:hi]
+
+    def as_data_engine(self) -> dd.DataEngine:
+        '''A DataEngine backed by the stored matrices, ready to hand to a Backtester.'''
+
+        data = dd.DataEngine()
+        index = pd.DatetimeIndex(self.dates)
+        data.rets_df = pd.DataFrame(self.rets, index=index, columns=self.tickers, copy=False)
+        data.price_df = pd.DataFrame(self.prices, index=index, columns=self.tickers, copy=False)
+        data.quality = DataQualityIndex.load(self.folder)
+        data.ticker_hashes = self.ticker_hashes
+        return data
+
+
+class UniverseRegistry:
+    '''Named universes (defined in universes.json) and their precomputed matrices, kept under one folder.
+
+    Every build of a universe goes in its own folder and is only switched to (by rewriting the CURRENT file) once
+    it is complete, so anything still reading an older build is never disturbed. The definitions and loaded
+    universes are cached, so call refresh to pick up changes made by another process.
+    '''
+
+    def __init__(self, folder: str = dd.DATA_FOLDER) -> None:
+        self.folder = folder
+        self.definitions_path = os.path.join(folder, UNIVERSES_FILE)
+        self._loaded: dict[str, Universe] = {}
+        if not os.path.exists(self.definitions_path):
+            os.makedirs(folder, exist_ok=True)
+            self._write_definitions(DEFAULT_UNIVERSES)
+        self._definitions = self._read_definitions()
+
+    def _read_definitions(self) -> dict[str, list[str]]:
+        with open(self.definitions_path) as f:
+            return json.load(f)
+
+    def _write_definitions(self, definitions: dict[str, list[str]]) -> None:
+        utils.atomic_write(self.definitions_path, json.dumps(definitions, indent=2).encode())
+        self._definitions = definitions
+
+    def _universe_folder(self, name: str) -> str:
+        return os.path.join(self.folder, UNIVERSES_FOLDER, name)
+
+    @property
+    def definitions(self) -> dict[str, list[str]]:
+        return dict(self._definitions)
+
+    def define(self, name: str, tickers: list[str]) -> None:
+        '''Add a universe, or change the tickers in an existing one. Its matrices are rebuilt on the next build.'''
+        self._write_definitions({**self.definitions, name: list(dict.fromkeys(tickers))})
+
+    def remove(self, name: str) -> None:
+        definitions = self.definitions
+        definitions.pop(name, None)
+        self._write_definitions(definitions)
+        self._loaded.pop(name, None)
+        shutil.rmtree(self._universe_folder(name), ignore_errors=True)
+
+    def _current_build(self, name: str) -> str | None:
+        try:
+            with open(os.path.join(self._universe_folder(name), CURRENT_FILE)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _prune(self, name: str) -> None:
+        '''Delete all but the newest MAX_BUILDS_KEPT builds of a universe. Temp folders are builds still being
+        written (maybe by another process), so they are left alone and don't count towards the builds kept.'''
+        folder = self._universe_folder(name)
+        builds = [os.path.join(folder, d) for d in os.listdir(folder)
+                  if not d.startswith(TMP_PREFIX) and os.path.isdir(os.path.join(folder, d))]
+        builds.sort(key=os.path.getmtime, reverse=True)
+        for build_folder in builds[MAX_BUILDS_KEPT:]:
+            shutil.rmtree(build_folder, ignore_errors=True)
+
+    @staticmethod
+    def _version(tickers: list[str], data: dd.DataEngine) -> tuple[str, dict[str, str]]:
+        '''Version of the universe's slice of the data. Uses the snapshot content hashes when we have them, otherwise
+        hashes the returns themselves.'''
+
+        if all(ticker in data.ticker_hashes for ticker in tickers):
+            hashes = {ticker: data.ticker_hashes[ticker] for ticker in tickers}
+            return tickers_version(hashes), hashes
+        rows = pd.util.hash_pandas_object(data.rets_df[tickers], index=True).to_numpy()
+        return content_hash(rows.tobytes() + ','.join(tickers).encode())[:16], {}
+
+    def build(self, data: dd.DataEngine, names: list[str] = None) -> list[str]:
+        '''Precompute the matrices for the given universes (all of them by default) from the data. Universes whose
+        data hasn't changed are left alone, and ones with tickers missing from the data are skipped. Returns the
+        names of the universes that were (re)built.'''
+
+        built = []
+        for name, tickers in self.definitions.items():
+            if names is not None and name not in names:
+                continue
+            if any(ticker not in data.tickers for ticker in tickers):
+                continue
+
+            version, hashes = self._version(tickers, data)
+            existing = self.load(name)
+            if existing is not None and existing.version == version and existing.tickers == tickers:
+                continue
+
+            # Only keep the dates where at least one of the universe's tickers has a return
+            rets_df = data.rets_df[tickers]
+            rets_df = rets_df[rets_df.notna().any(axis=1)]
+            rets = np.ascontiguousarray(rets_df.to_numpy(dtype=np.float64))
+            prices = np.ascontiguousarray(data.price_df.reindex(index=rets_df.index, columns=tickers).to_numpy(dtype=np.float64))
+            dates = rets_df.index.to_numpy(dtype='datetime64[ns]')
+
+            all_valid = ~np.isnan(rets).any(axis=1)
+            valid_rows = np.flatnonzero(all_valid)
+            if len(valid_rows):
+                first, last = valid_rows[0], valid_rows[-1]
+                common_start, common_end = str(pd.Timestamp(dates[first]).date()), str(pd.Timestamp(dates[last]).date())
+                gaps = dates[first:last + 1][~all_valid[first:last + 1]]
+            else:
+                common_start = common_end = None
+                gaps = np.array([], dtype='datetime64[ns]')
+
+            # The same data and tickers always get the same build id
+            build_id = content_hash(json.dumps([version, tickers]).encode())[:16]
+            folder = self._universe_folder(name)
+            build_folder = os.path.join(folder, build_id)
+            os.makedirs(folder, exist_ok=True)
+            if not os.path.exists(build_folder):
+                # Write everything to a temp folder and move it into place once complete
+                tmp_folder = tempfile.mkdtemp(dir=folder, prefix=TMP_PREFIX)
+                try:
+                    np.save(os.path.join(tmp_folder, 'rets.npy'), rets)
+                    np.save(os.path.join(tmp_folder, 'prices.npy'), prices)
+                    np.save(os.path.join(tmp_folder, 'dates.npy'), dates)
+                    np.save(os.path.join(tmp_folder, 'gaps.npy'), gaps)
+                    if data.quality is not None:
+                        DataQualityIndex({t: data.quality[t] for t in tickers if t in data.quality}).save(tmp_folder)
+                    meta = {'name': name, 'tickers': tickers, 'version': version, 'ticker_hashes': hashes,
+                            'common_start': common_start, 'common_end': common_end}
+                    with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+                        json.dump(meta, f)
+                    os.replace(tmp_folder, build_folder)
+                except OSError:
+                    # Someone else finished the same build first, theirs is identical
+                    shutil.rmtree(tmp_folder, ignore_errors=True)
+                    if not os.path.exists(build_folder):
+                        raise
+
+            utils.atomic_write(os.path.join(folder, CURRENT_FILE), build_id.encode())
+            self._loaded[name] = Universe(build_folder)
+            self._prune(name)
+            built.append(name)
+        return built
+
+    def load(self, name: str) -> Universe | None:
+        '''The current build of a universe (None if it has never been built). Cached after the first load.'''
+        if name not in self._loaded:
+            build_id = self._current_build(name)
+            if build_id is None:
+                return None
+            self._loaded[name] = Universe(os.path.join(self._universe_folder(name), build_id))
+        return self._loaded[name]
+
+    def refresh(self) -> None:
+        '''Re-read the definitions and reload any universe whose current build has changed since it was loaded.'''
+        self._definitions = self._read_definitions()
+        for name, universe in list(self._loaded.items()):
+            if os.path.basename(universe.folder) != self._current_build(name):
+                del self._loaded[name]
+
+    def find(self, tickers: list[str], start, end) -> Universe | None:
+        '''The smallest built universe that covers every ticker over [start, end], if there is one. Only looks at
+        the cached universes, so this never touches the disk once they are loaded.'''
+
+        candidates = [universe for universe in (self.load(name) for name in self.definitions)
+                      if universe is not None and universe.covers(tickers, start, end)]
+        return min(candidates, key=lambda universe: len(universe.tickers), default=None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the universe registry.')
+    parser.add_argument('--folder', default=dd.DATA_FOLDER, help='Folder with the registry and saved data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list')
+    define_parser = subparsers.add_parser('define')
+    define_parser.add_argument('name')
+    define_parser.add_argument('tickers', nargs='+')
+    remove_parser = subparsers.add_parser('remove')
+    remove_parser.add_argument('name')
+    subparsers.add_parser('build')
+    args = parser.parse_args()
+
+    registry = UniverseRegistry(args.folder)
+    if args.command == 'define':
+        registry.define(args.name, args.tickers)
+    elif args.command == 'remove':
+        registry.remove(args.name)
+    elif args.command == 'build':
+        print(f'Built: {registry.build(dd.DataEngine.load_saved_data(args.folder))}')
+    for name, tickers in registry.definitions.items():
+        print(registry.load(name) or f'Universe {name}: {len(tickers)} tickers, not built')
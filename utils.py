@@ -1,3 +1,7 @@
+import contextlib
+import os
+import tempfile
+import numpy as np
 import pandas as pd
 import datetime as dt
 
@@ -6,6 +10,57 @@ def convert_dt_index(df:pd.DataFrame) -> pd.DataFrame:
     df.index = pd.to_datetime(df.index).date
     return df
 
+def atomic_write(path: str, data: bytes) -> None:
+    '''Write to a temp file next to path and move it into place, so readers never see a half written file.'''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    '''Hold an exclusive lock on path (created if needed) for the length of a with block. Every call opens its own
+    handle, so it keeps out other threads as well as other processes.'''
+    with open(path, 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK only retries for about 10 seconds before giving up
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def run_bounds(flags: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Find every run of True in every column of a 2D boolean array in one pass. Returns the column, first row and
+    last row (inclusive) of each run, sorted by column and then row.'''
+    n_rows, n_cols = flags.shape
+    # Pad with False on both ends so every run has a rising and a falling edge. Transposing first means the
+    # nonzero results come back grouped by column.
+    padded = np.zeros((n_cols, n_rows + 2), dtype=np.int8)
+    padded[:, 1:-1] = flags.T
+    col, pos = np.nonzero(np.diff(padded, axis=1))
+    # Edges alternate rise, fall within each column
+    return col[::2], pos[::2], pos[1::2] - 1
+
 def color_returns(val):
     color = "green" if val > 0 else "red"
     return f"color: {color}"